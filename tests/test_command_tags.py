@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
 import os
 import re
 import shutil
+import stat
 import sys
 import tempfile
 import unittest
@@ -13,8 +15,8 @@ from nikola import nikola
 sys.path.append(os.path.join('v6', 'tags'))
 
 from tags import (
-    _AutoTag, add_tags, list_tags, merge_tags, remove_tags, search_tags,
-    sort_tags
+    _AutoTag, add_tags, apply_tag_operations, list_tags, merge_tags,
+    remove_tags, search_tags, sort_tags
 )
 from nikola.utils import _reload, LOGGER
 import logbook
@@ -68,6 +70,30 @@ class TestCommandTags(unittest.TestCase):
         self.assertTrue('test_nikola' in new_tags)
         self.assertEquals(set(new_parsed_tags), set(DEMO_TAGS))
 
+    def test_add_keeps_file_mode(self):
+        posts = [os.path.join('posts', post) for post in os.listdir('posts')]
+        os.chmod(posts[0], 0o640)
+
+        add_tags(self._site, 'test_nikola', posts)
+
+        self.assertEquals(0o640, stat.S_IMODE(os.stat(posts[0]).st_mode))
+
+    def test_apply_operations(self):
+        posts = [os.path.join('posts', post) for post in os.listdir('posts')]
+        operations = [
+            ('merge', 'nikola, python'), ('add', 'test_nikola'), ('sort', '')
+        ]
+
+        new_tags = apply_tag_operations(
+            self._site, operations, posts, workers=2
+        )
+        new_parsed_tags = self._parse_new_tags(posts[0])
+
+        self.assertEquals(
+            ['blog', 'demo', 'python', 'test_nikola'], new_parsed_tags
+        )
+        self.assertEquals(new_tags[posts[0]], new_parsed_tags)
+
     def test_auto_tag_basic(self):
         post = os.path.join('posts', os.listdir('posts')[0])
         tagger = _AutoTag(self._site, use_nltk=False)
@@ -96,6 +122,26 @@ class TestCommandTags(unittest.TestCase):
         tags = [tag for tag in nltk_tags if tag_pattern.search(tag)]
         self.assertEquals(len(tags), 5)
 
+    def test_auto_tag_all(self):
+        tagger = _AutoTag(self._site, use_nltk=False)
+        all_tags = tagger.tag_all()
+
+        for post in self._site.timeline:
+            self.assertEquals(tagger.tag(post), all_tags[post.source_path])
+
+    def test_auto_tag_cache(self):
+        post = os.path.join('posts', os.listdir('posts')[0])
+        tagger = _AutoTag(self._site, use_nltk=False)
+        tags = tagger.tag(post)
+
+        with open(tagger._cache_path()) as f:
+            cache = json.load(f)
+        self.assertTrue(post in cache['documents'])
+
+        # a second tagger should reuse the cached word counts.
+        cached_tagger = _AutoTag(self._site, use_nltk=False)
+        self.assertEquals(tags, cached_tagger.tag(post))
+
     def test_list(self):
         self.assertEquals(sorted(DEMO_TAGS), list_tags(self._site))
 
@@ -164,6 +210,17 @@ class TestCommandTags(unittest.TestCase):
             tags = search_tags(self._site, term)
             self.assertEquals(tags, search_terms[term])
 
+    def test_search_modes(self):
+        search_terms = {
+            ('ni', 'prefix'): ['nikola'],
+            ('o', 'substring'): ['blog', 'demo', 'nikola', 'python'],
+            ('nikla', 'fuzzy'): ['nikola'],
+            ('pyhton', 'fuzzy'): ['python'],
+        }
+        for term, mode in search_terms:
+            tags = search_tags(self._site, term, mode)
+            self.assertEquals(tags, search_terms[(term, mode)])
+
     def test_sort(self):
         posts = [os.path.join('posts', post) for post in os.listdir('posts')]
 
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from distutils.spawn import find_executable
+
+from docutils.core import publish_parts
+from docutils.parsers.rst import directives
+
+sys.path.append(os.path.join('v6', 'graphviz'))
+
+from graphviz import DiGraph, DotPool, DotWorker, Graphviz, RenderCache
+from nikola.utils import LOGGER
+
+# A stand-in for dot: it renders every graph read on its stdin as soon
+# as its closing brace is read, to a fake SVG titled like dot does.  Its
+# first argument makes it hang on, or exit at, graphs with a node of
+# that name.
+FAKE_DOT = '''import sys, time
+fail = sys.argv[1] if len(sys.argv) > 2 else None
+graph, depth = [], 0
+for line in iter(sys.stdin.readline, ''):
+    graph.append(line)
+    depth += line.count('{') - line.count('}')
+    if depth or '}' not in line:
+        continue
+    source, graph = ''.join(graph), []
+    if fail and fail in source:
+        if fail == 'hang':
+            time.sleep(60)
+        sys.exit(1)
+    name = source.split('{')[0].split()[-1]
+    sys.stdout.write('<svg>\\n<!-- Title: %s Pages: 1 -->\\n%s\\n</svg>\\n' % (
+        name, source.count('->')))
+    sys.stdout.flush()
+'''
+
+GRAPH = 'digraph foo {\n  a -> b;\n  b -> c;\n}'
+
+
+class FakeDotMixin(object):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dot = os.path.join(self.folder, 'dot.py')
+        with open(self.dot, 'w') as f:
+            f.write(FAKE_DOT)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def command(self, fail=None):
+        command = [sys.executable, self.dot]
+        if fail:
+            command.append(fail)
+        return command + ['-Tsvg']
+
+
+class TestDotWorker(FakeDotMixin, unittest.TestCase):
+    @staticmethod
+    def setUpClass():
+        LOGGER.notice('--- TESTS FOR graphviz')
+
+    @staticmethod
+    def tearDownClass():
+        sys.stdout.write('\n')
+        LOGGER.notice('--- END OF TESTS FOR graphviz')
+
+    def test_render(self):
+        worker = DotWorker(self.command(), 5)
+        try:
+            svg = worker.render(GRAPH)
+            process = worker.process
+            # The sentinel graphs are not part of the output
+            self.assertEqual(svg, b'<svg>\n<!-- Title: foo Pages: 1 -->\n2\n</svg>\n')
+            # The process is reused
+            self.assertEqual(worker.render(GRAPH.replace('foo', 'bar')),
+                             b'<svg>\n<!-- Title: bar Pages: 1 -->\n2\n</svg>\n')
+            self.assertTrue(worker.process is process)
+        finally:
+            worker.stop()
+
+    def test_trailing_semicolon(self):
+        worker = DotWorker(self.command(), 5)
+        try:
+            self.assertEqual(worker.render(GRAPH + ';'),
+                             b'<svg>\n<!-- Title: foo Pages: 1 -->\n2\n</svg>\n')
+        finally:
+            worker.stop()
+
+    def test_error(self):
+        worker = DotWorker(self.command('broken'), 5)
+        try:
+            self.assertEqual(worker.render('digraph x { broken }'), None)
+            self.assertEqual(worker.process, None)
+            # A new process is started for the next graph
+            self.assertTrue(worker.render(GRAPH))
+        finally:
+            worker.stop()
+
+    def test_timeout(self):
+        worker = DotWorker(self.command('hang'), 0.5)
+        try:
+            start = time.time()
+            self.assertEqual(worker.render('digraph x { hang }'), None)
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(worker.process, None)
+        finally:
+            worker.stop()
+
+    def test_pool(self):
+        pool = DotPool(self.command(), 2, 5)
+        try:
+            self.assertTrue(pool.render(GRAPH))
+            self.assertEqual(pool.idle.qsize(), 2)
+        finally:
+            pool.close()
+        for worker in pool.workers:
+            self.assertEqual(worker.process, None)
+
+
+class TestGraphvizDirective(FakeDotMixin, unittest.TestCase):
+    """Graphs the pool can't render are rendered by a new dot process."""
+
+    def setUp(self):
+        super(TestGraphvizDirective, self).setUp()
+        self.options = dict(
+            (name, getattr(Graphviz, name, None))
+            for name in ('dot_path', 'pool', 'cache', 'embed_graph'))
+        self.pool = DotPool(self.command('hang'), 1, 0.5)
+        Graphviz.pool = self.pool
+        Graphviz.cache = None
+        Graphviz.embed_graph = True
+        directives.register_directive('digraph', DiGraph)
+
+    def tearDown(self):
+        self.pool.close()
+        for name, value in self.options.items():
+            setattr(Graphviz, name, value)
+        super(TestGraphvizDirective, self).tearDown()
+
+    def render(self, source):
+        return publish_parts(source, writer_name='html',
+                             settings_overrides={'report_level': 5})['body']
+
+    def test_fallback(self):
+        dot = os.path.join(self.folder, 'dot')
+        with open(dot, 'w') as f:
+            f.write('#!{0}\n{1}'.format(sys.executable, FAKE_DOT))
+        os.chmod(dot, 0o755)
+        Graphviz.dot_path = dot
+
+        body = self.render('.. digraph::\n\n   hang -> b\n')
+
+        self.assertTrue('Pages: 1' in body)
+        self.assertEqual(self.pool.workers[0].process, None)
+
+
+class RecordingCache(RenderCache):
+    def __init__(self, *args):
+        super(RecordingCache, self).__init__(*args)
+        self.logged = []
+
+    def log_stats(self, source):
+        self.logged.append((self.hits, self.misses))
+        super(RecordingCache, self).log_stats(source)
+
+
+class TestCacheStats(FakeDotMixin, unittest.TestCase):
+    """The cache stats are logged when each document is rendered."""
+
+    def setUp(self):
+        super(TestCacheStats, self).setUp()
+        self.options = dict(
+            (name, getattr(Graphviz, name, None))
+            for name in ('dot_path', 'pool', 'cache', 'embed_graph'))
+        dot = os.path.join(self.folder, 'dot')
+        with open(dot, 'w') as f:
+            f.write('#!{0}\n{1}'.format(sys.executable, FAKE_DOT))
+        os.chmod(dot, 0o755)
+        Graphviz.dot_path = dot
+        Graphviz.pool = None
+        Graphviz.cache = RecordingCache(os.path.join(self.folder, 'cache'),
+                                        1024 * 1024)
+        Graphviz.embed_graph = True
+        directives.register_directive('digraph', DiGraph)
+
+    def tearDown(self):
+        for name, value in self.options.items():
+            setattr(Graphviz, name, value)
+        super(TestCacheStats, self).tearDown()
+
+    def render(self, source):
+        return publish_parts(source, writer_name='html',
+                             settings_overrides={'report_level': 5})['body']
+
+    def test_stats(self):
+        source = '.. digraph::\n\n   a -> b\n\n.. digraph::\n\n   b -> c\n'
+        self.render(source)
+        self.render(source + '\n.. digraph::\n\n   c -> d\n')
+
+        # Logged once per document, and reset after each
+        self.assertEqual(Graphviz.cache.logged, [(0, 2), (2, 1)])
+        self.assertEqual(Graphviz.cache.hits, 0)
+        self.assertEqual(Graphviz.cache.misses, 0)
+
+
+@unittest.skipUnless(find_executable('dot'), 'dot is not installed')
+class TestRealDot(unittest.TestCase):
+    """The protocol of DotWorker, with the real dot."""
+
+    def test_render(self):
+        worker = DotWorker(['dot', '-Tsvg'], 30)
+        try:
+            for name in ('foo', 'bar'):
+                svg = worker.render(GRAPH.replace('foo', name) + ';')
+                self.assertTrue('<!-- Title: {0} '.format(name).encode('utf-8') in svg)
+                self.assertFalse(DotWorker.END.encode('utf-8') in svg)
+                self.assertFalse(DotWorker.PAD.encode('utf-8') in svg)
+        finally:
+            worker.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
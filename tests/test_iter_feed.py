@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import feedparser
+
+sys.path.append(os.path.join('v7', 'planetoid'))
+sys.path.append(os.path.join('v7', 'import_feed'))
+
+from import_feed import CommandImportFeed
+from planetoid import iter_feed, Planetoid
+from nikola.utils import LOGGER
+
+RSS = b'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"
+     xmlns:content="http://purl.org/rss/1.0/modules/content/">
+  <channel>
+    <title>RSS feed</title>
+    <link>http://example.com/</link>
+    <description>An RSS 2.0 feed</description>
+    <language>en</language>
+    <item>
+      <title>First</title>
+      <link>http://example.com/1</link>
+      <guid>http://example.com/1</guid>
+      <pubDate>Wed, 01 Jan 2014 10:00:00 GMT</pubDate>
+      <dc:creator>Alice</dc:creator>
+      <category>python</category>
+      <description>Summary &amp; more</description>
+      <content:encoded><![CDATA[<p>Hello <b>world</b></p>]]></content:encoded>
+    </item>
+    <item>
+      <title>Second</title>
+      <link>http://example.com/2</link>
+      <pubDate>Thu, 02 Jan 2014 10:00:00 GMT</pubDate>
+      <description>Just a description</description>
+    </item>
+  </channel>
+</rss>
+'''
+
+ATOM = b'''<?xml version="1.0" encoding="utf-8"?>
+<a:feed xmlns:a="http://www.w3.org/2005/Atom"
+        xmlns:media="http://search.yahoo.com/mrss/"
+        xml:lang="es" xml:base="http://example.com/">
+  <a:title type="text">Atom feed</a:title>
+  <a:id>urn:test</a:id>
+  <a:link rel="alternate" href="/"/>
+  <a:updated>2014-01-02T00:00:00Z</a:updated>
+  <a:author><a:name>Bob</a:name></a:author>
+  <a:entry>
+    <a:title>Primera</a:title>
+    <a:id>urn:test:1</a:id>
+    <a:link rel="alternate" href="1.html"/>
+    <a:published>2014-01-01T00:00:00Z</a:published>
+    <a:updated>2014-01-01T12:00:00Z</a:updated>
+    <a:category term="nikola"/>
+    <a:content type="html">&lt;p&gt;Hola&lt;/p&gt;</a:content>
+    <media:thumbnail url="http://example.com/1.png"/>
+  </a:entry>
+  <a:entry xml:lang="en">
+    <a:title>Second</a:title>
+    <a:id>urn:test:2</a:id>
+    <a:link rel="alternate" href="2.html"/>
+    <a:updated>2014-01-02T00:00:00Z</a:updated>
+    <a:summary>Only a summary</a:summary>
+  </a:entry>
+</a:feed>
+'''
+
+
+class TestIterFeed(unittest.TestCase):
+    """iter_feed must give the same results as feedparser.parse."""
+
+    @staticmethod
+    def setUpClass():
+        LOGGER.notice('--- TESTS FOR iter_feed')
+
+    @staticmethod
+    def tearDownClass():
+        sys.stdout.write('\n')
+        LOGGER.notice('--- END OF TESTS FOR iter_feed')
+
+    def assertSameAsFeedparser(self, data):
+        expected = feedparser.parse(data)
+        parsed = iter_feed(io.BytesIO(data))
+        entries = list(parsed.entries)
+
+        self.assertEqual(parsed.feed, expected.feed)
+        self.assertEqual(parsed.version, expected.version)
+        self.assertEqual(parsed.namespaces, expected.namespaces)
+        self.assertEqual(len(entries), len(expected.entries))
+        for entry, expected_entry in zip(entries, expected.entries):
+            self.assertEqual(entry, expected_entry)
+
+    def test_rss(self):
+        self.assertSameAsFeedparser(RSS)
+
+    def test_namespaced_atom(self):
+        self.assertSameAsFeedparser(ATOM)
+
+    def test_undefined_entity(self):
+        # Entries after the malformed one come from feedparser
+        for title in (b'First', b'Second'):
+            data = RSS.replace(b'<title>' + title,
+                               b'<title>' + title + b'&nbsp;!')
+            parsed = iter_feed(io.BytesIO(data))
+
+            self.assertEqual([e.title for e in parsed.entries],
+                             [e.title for e in feedparser.parse(data).entries])
+            self.assertEqual(len(feedparser.parse(data).entries), 2)
+
+    def test_malformed_entry(self):
+        data = RSS.replace(b'<title>Second</title>', b'<title>Second</titel>')
+        parsed = iter_feed(io.BytesIO(data))
+
+        self.assertEqual(len(list(parsed.entries)),
+                         len(feedparser.parse(data).entries))
+
+    def test_malformed_feed(self):
+        data = RSS.replace(b'<title>RSS feed</title>', b'<title>RSS & feed</title>')
+
+        self.assertRaises(SyntaxError, iter_feed, io.BytesIO(data))
+
+
+class MockPluginManager(object):
+    def __init__(self, plugins):
+        self.plugins = plugins
+
+    def getPluginByName(self, name, category):
+        return self.plugins.get(name)
+
+
+class MockPluginInfo(object):
+    def __init__(self, plugin_object):
+        self.plugin_object = plugin_object
+
+
+class MockSite(object):
+    def __init__(self, plugins):
+        self.plugin_manager = MockPluginManager(plugins)
+
+
+class TestImportFeedChannel(unittest.TestCase):
+    """import_feed parses files with planetoid's iter_feed, if it can."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'feed.xml')
+        with open(self.path, 'wb') as f:
+            f.write(RSS)
+        self.command = CommandImportFeed()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_with_planetoid(self):
+        self.command.site = MockSite({'planetoid': MockPluginInfo(Planetoid())})
+        channel = self.command.get_channel_from_file(self.path)
+
+        self.assertFalse(isinstance(channel.entries, list))
+        self.assertEqual([e.title for e in channel.entries], ['First', 'Second'])
+
+    def test_without_planetoid(self):
+        self.command.site = MockSite({})
+        channel = self.command.get_channel_from_file(self.path)
+
+        self.assertEqual([e.title for e in channel.entries], ['First', 'Second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import os
+import socket
+import sys
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # NOQA
+    from socketserver import ThreadingMixIn  # NOQA
+
+sys.path.append(os.path.join('v7', 'planetoid'))
+
+from planetoid import FeedFetcher
+from nikola.utils import LOGGER
+
+ATOM = b'''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Test feed</title>
+  <id>urn:test</id>
+  <updated>2014-01-01T00:00:00Z</updated>
+  <entry>
+    <title>First</title>
+    <id>urn:test:1</id>
+    <link href="http://example.com/1"/>
+    <updated>2014-01-01T00:00:00Z</updated>
+    <content>Hello</content>
+  </entry>
+</feed>
+'''
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """Serve ATOM on any path, with an etag, and a 500 on /flaky once."""
+
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+    failures = {'/flaky': 1}
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        if self.failures.get(self.path):
+            self.failures[self.path] -= 1
+            self._reply(500, b'')
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self._reply(304, b'')
+        else:
+            self._reply(200, ATOM)
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockFeed(object):
+    def __init__(self, url, etag='foo'):
+        self.url = url
+        self.etag = etag
+        self.last_modified = datetime.datetime(1970, 1, 1)
+
+
+class TestFeedFetcher(unittest.TestCase):
+    @staticmethod
+    def setUpClass():
+        LOGGER.notice('--- TESTS FOR planetoid')
+
+    @staticmethod
+    def tearDownClass():
+        sys.stdout.write('\n')
+        LOGGER.notice('--- END OF TESTS FOR planetoid')
+
+    def setUp(self):
+        FeedHandler.connections.clear()
+        FeedHandler.failures['/flaky'] = 1
+        self.server = FeedServer(('127.0.0.1', 0), FeedHandler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_all(self):
+        feeds = [MockFeed('%s/feed/%d' % (self.base_url, i)) for i in range(10)]
+        results = list(FeedFetcher(workers=2).fetch_all(feeds))
+
+        self.assertEqual(len(results), 10)
+        for feed, parsed in results:
+            self.assertEqual(parsed.status, 200)
+            self.assertEqual(parsed.etag, '"v1"')
+            self.assertEqual(parsed.feed.title, 'Test feed')
+            self.assertEqual([e.title for e in parsed.entries], ['First'])
+        # Connections are reused, so there is at most one per worker
+        self.assertTrue(len(FeedHandler.connections) <= 2)
+
+    def test_not_modified(self):
+        feed = MockFeed(self.base_url + '/feed', etag='"v1"')
+        [(_, parsed)] = FeedFetcher().fetch_all([feed])
+
+        self.assertEqual(parsed.status, 304)
+        self.assertEqual(parsed.entries, [])
+
+    def test_retry(self):
+        feed = MockFeed(self.base_url + '/flaky')
+        [(_, parsed)] = FeedFetcher(backoff=0).fetch_all([feed])
+
+        self.assertEqual(parsed.status, 200)
+
+    def test_failure(self):
+        # Nothing listens on the port of a closed socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        feed = MockFeed('http://127.0.0.1:%d/feed' % port)
+        [(_, parsed)] = FeedFetcher(retries=0).fetch_all([feed])
+
+        self.assertEqual(parsed, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,13 +24,21 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import atexit
 import hashlib
 import os
+import threading
 from subprocess import Popen, PIPE
 
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue  # NOQA
+
 from docutils import nodes
 from docutils.parsers.rst import Directive, directives
 from docutils.statemachine import StringList
+from docutils.transforms import Transform
 
 from nikola.plugin_categories import RestExtension
 from nikola.utils import LOGGER, makedirs
@@ -49,9 +57,243 @@ class Plugin(RestExtension):
         Graphviz.output_folder = self.site.config.get('GRAPHVIZ_OUTPUT', 'output/assets/graphviz')
         Graphviz.graph_path = self.site.config.get('GRAPHVIZ_GRAPH_PATH', '/assets/graphviz/')
         Graphviz.dot_path = self.site.config.get('GRAPHVIZ_DOT', 'dot')
+        if self.site.config.get('GRAPHVIZ_CACHE', True):
+            Graphviz.cache = RenderCache(
+                os.path.join(self.site.config.get('CACHE_FOLDER', 'cache'), 'graphviz'),
+                self.site.config.get('GRAPHVIZ_CACHE_SIZE', 50 * 1024 * 1024))
+        else:
+            Graphviz.cache = None
+        # Graphs are rendered one at a time, so one dot process is enough;
+        # the pool is kept if set_site is called again with the same settings
+        pool_args = ([Graphviz.dot_path, '-Tsvg'],
+                     self.site.config.get('GRAPHVIZ_WORKERS', 0),
+                     self.site.config.get('GRAPHVIZ_WORKER_TIMEOUT', 30))
+        if Graphviz.pool is not None and Graphviz.pool.args != pool_args:
+            Graphviz.pool.close()
+            Graphviz.pool = None
+        if pool_args[1] and Graphviz.pool is None:
+            Graphviz.pool = DotPool(*pool_args)
         return super(Plugin, self).set_site(site)
 
 
+class RenderCache(object):
+    """ On-disk cache of the SVG rendered by dot, keyed by a hash of the
+        graph source, the dot version and the command line.
+
+        Entries are touched when used, and the least recently used ones are
+        removed when the cache grows over max_size bytes.
+    """
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._versions = {}
+
+    def key(self, command, data):
+        h = hashlib.sha1()
+        h.update(self.dot_version(command[0]))
+        h.update('\0'.join(command[1:]).encode('utf-8'))
+        h.update(b'\0')
+        h.update(data.encode('utf-8'))
+        return h.hexdigest()
+
+    def dot_version(self, dot_path):
+        if dot_path not in self._versions:
+            p = Popen([dot_path, '-V'], stdout=PIPE, stderr=PIPE)
+            out, err = p.communicate()
+            # dot prints its version to stderr
+            self._versions[dot_path] = out + err
+        return self._versions[dot_path]
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + '.svg')
+        try:
+            with open(path, 'rb') as inf:
+                data = inf.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = os.path.join(self.folder, key + '.svg')
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            makedirs(self.folder)
+            with open(temp_path, 'wb+') as outf:
+                outf.write(data)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            LOGGER.warn("Graphviz: can't write to the cache: {0}".format(e))
+            return
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries, until the cache uses
+            at most 3/4 of max_size. """
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if self._size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def _entries(self):
+        for name in os.listdir(self.folder):
+            if not name.endswith('.svg'):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield st.st_mtime, st.st_size, path
+
+    def log_stats(self, source):
+        """ Log the hits and misses since the last call, and reset them. """
+        if self.hits or self.misses:
+            LOGGER.info('Graphviz cache: {0} hits, {1} misses in {2}'.format(
+                self.hits, self.misses, source))
+        self.hits = self.misses = 0
+
+
+class LogCacheStats(Transform):
+    """ Log the cache stats of a document once it has been parsed.
+
+        This runs in the task that renders the document, so the stats are
+        logged even when posts are rendered by parallel worker processes,
+        which never run their atexit handlers.
+    """
+
+    default_priority = 900
+
+    def apply(self):
+        if Graphviz.cache:
+            Graphviz.cache.log_stats(self.document.get('source'))
+
+
+class DotWorker(object):
+    """ A long-lived dot process, rendering one graph at a time.
+
+        Each graph is followed by two empty sentinel graphs: the output of
+        the first one marks the end of the graph's output, and the second
+        one lets dot finish parsing the first one if it needs to read ahead.
+    """
+
+    END = 'nikola_graphviz_end'
+    PAD = 'nikola_graphviz_pad'
+
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        self.process = None
+
+    def start(self):
+        # Errors are reported by rendering the graph again with a new process
+        with open(os.devnull, 'wb') as devnull:
+            self.process = Popen(self.command, stdin=PIPE, stdout=PIPE, stderr=devnull)
+        self.output = Queue()
+        reader = threading.Thread(target=self._read_output,
+                                  args=(self.process.stdout, self.output))
+        reader.daemon = True
+        reader.start()
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def render(self, data):
+        """ Return the SVG for a graph, or None if it could not be rendered. """
+        if self.process is None or self.process.poll() is not None:
+            self.stop()
+            self.start()
+        # A ';' after a graph (as the graph and digraph directives write)
+        # would be a syntax error in front of the next graph of the stream
+        graphs = u'{0}\ngraph {1} {{}}\ngraph {2} {{}}\n'.format(
+            data.rstrip().rstrip(';'), self.END, self.PAD)
+        try:
+            self.process.stdin.write(graphs.encode('utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.stop()
+            return None
+        svg_data = b''
+        while True:
+            try:
+                svg = self.output.get(timeout=self.timeout)
+            except Empty:
+                svg = None
+            if svg is None:  # dot exited or hung on a broken graph
+                self.stop()
+                return None
+            if self._is_graph(svg, self.PAD):
+                continue
+            if self._is_graph(svg, self.END):
+                return svg_data or None
+            svg_data += svg
+
+    @staticmethod
+    def _is_graph(svg, name):
+        return '<!-- Title: {0} '.format(name).encode('utf-8') in svg
+
+    @staticmethod
+    def _read_output(stdout, output):
+        svg = []
+        for line in iter(stdout.readline, b''):
+            svg.append(line)
+            if line.startswith(b'</svg>'):
+                output.put(b''.join(svg))
+                svg = []
+        output.put(None)
+
+
+class DotPool(object):
+    """ A pool of DotWorkers, that directives hand graphs to. """
+
+    def __init__(self, command, size, timeout):
+        self.args = (command, size, timeout)
+        self.workers = [DotWorker(command, timeout) for i in range(size)]
+        self.idle = Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        atexit.register(self.close)
+
+    def render(self, data):
+        worker = self.idle.get()
+        try:
+            return worker.render(data)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+
 class Graphviz(Directive):
     """ Restructured text extension for inserting graphs as SVG
 
@@ -68,6 +310,8 @@ class Graphviz(Directive):
     required_arguments = 0
     optional_arguments = 1
     ignore_alt = True
+    cache = None
+    pool = None
     option_spec = {
         'alt': directives.unchanged,
         'inline': directives.flag,
@@ -88,13 +332,28 @@ class Graphviz(Directive):
             data = '\n'.join(self.content)
         node_list = []
         try:
-            p = Popen([self.dot_path, '-Tsvg'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            svg_data, errors = p.communicate(input=data)
-            code = p.wait()
-            if code:  # Some error
+            command = [self.dot_path, '-Tsvg']
+            svg_data = None
+            if self.cache:
+                key = self.cache.key(command, data)
+                svg_data = self.cache.get(key)
                 document = self.state.document
-                return [document.reporter.error(
-                        'Error processing graph: {0}'.format(errors), line=self.lineno)]
+                if not getattr(document, 'graphviz_stats', False):
+                    document.graphviz_stats = True
+                    document.transformer.add_transform(LogCacheStats)
+            if svg_data is None:
+                if self.pool:
+                    svg_data = self.pool.render(data)
+                if svg_data is None:
+                    p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                    svg_data, errors = p.communicate(input=data.encode('utf-8'))
+                    code = p.wait()
+                    if code:  # Some error
+                        document = self.state.document
+                        return [document.reporter.error(
+                                'Error processing graph: {0}'.format(errors), line=self.lineno)]
+                if self.cache:
+                    self.cache.put(key, svg_data)
             if self.embed_graph:  # SVG embedded in the HTML
                 if 'inline' in self.options:
                     svg_data = '<span class="graphviz">{0}</span>'.format(svg_data)
@@ -26,12 +26,38 @@
 
 from __future__ import print_function, unicode_literals
 
+import codecs
+import hashlib
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
 from nikola.plugin_categories import LateTask
-from nikola.utils import config_changed, LOGGER
+from nikola.utils import config_changed, LOGGER, makedirs
 
 import enchant
-from enchant.checker import SpellChecker
-from enchant.tokenize import EmailFilter, URLFilter
+from enchant.tokenize import (
+    EmailFilter, get_tokenizer, TokenizerNotFoundError, URLFilter
+)
+
+
+def _write_json(path, data):
+    """ Write data to a JSON file, through a temporary file so that the
+    file is never left half-written. """
+
+    makedirs(os.path.dirname(path))
+    temp_path = '%s.%s.tmp' % (path, os.getpid())
+    with codecs.open(temp_path, 'w+', 'utf-8') as json_file:
+        json_file.write(json.dumps(data))
+
+    if hasattr(os, 'replace'):
+        os.replace(temp_path, path)
+
+    else:
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
 
 
 class RenderPosts(LateTask):
@@ -39,62 +65,298 @@ class RenderPosts(LateTask):
 
     name = 'spell_check'
 
+    # Bump this when the format of the verdict cache changes.
+    CACHE_VERSION = 1
+
+    # Bump this when the format of the aggregate report changes.
+    REPORT_VERSION = 2
+
+    # Number of words checked by a worker at a time.
+    CHUNK_SIZE = 64
+
     def __init__(self):
         super(RenderPosts, self).__init__()
-        self._dicts = dict()
-        self._langs = enchant.list_languages()
+        self._langs = None
+        self._tokenizers = dict()
+        self._local = threading.local()
+        self._pool = None
+        self._verdicts = None
 
     def gen_tasks(self):
         """ Run spell check on any post that may have changed. """
 
         self.site.scan_posts()
         kw = {'translations': self.site.config['TRANSLATIONS']}
+        cache_folder = os.path.join(
+            self.site.config['CACHE_FOLDER'], 'spell_check'
+        )
+        self._cache_path = os.path.join(cache_folder, 'verdicts.json')
+        self._workers = self.site.config.get('SPELL_CHECK_WORKERS', 4)
         yield self.group_task()
 
+        report_paths = []
         for lang in kw['translations']:
             for post in self.site.timeline[:]:
                 path = post.fragment_deps(lang)
+                report_path = os.path.join(
+                    cache_folder, 'reports', lang, '%s.json' % hashlib.md5(
+                        post.source_path.encode('utf-8')
+                    ).hexdigest()
+                )
+                report_paths.append(report_path)
                 task = {
                     'basename': self.name,
                     'name': path,
                     'file_dep': path,
-                    'actions': [(self.spell_check, (post, lang, ))],
+                    'targets': [report_path],
+                    'actions': [(self.spell_check, (post, lang, report_path))],
                     'clean': True,
                     'uptodate': [config_changed(kw)],
                 }
                 yield task
 
-    def spell_check(self, post, lang):
-        """ Check spellings for the given post and given language. """
+        # The aggregate report only reads the per-post reports that changed.
+        report_path = os.path.join(cache_folder, 'report.json')
+        yield {
+            'basename': self.name,
+            'name': report_path,
+            'file_dep': report_paths,
+            'targets': [report_path],
+            'actions': [(self.aggregate_reports, (report_path, ))],
+            'clean': True,
+            'uptodate': [config_changed({'reports': report_paths})],
+        }
+
+    def spell_check(self, post, lang, report_path=None):
+        """ Check spellings for the given post and given language.
+
+        The mis-spelt words, with their offsets in the text of the post,
+        are written to a JSON report.
+
+        """
 
-        if enchant.dict_exists(lang):
-            checker = SpellChecker(lang, filters=[EmailFilter, URLFilter])
-            checker.set_text(post.text(lang=lang, strip_html=True))
-            words = [error.word for error in checker]
-            words = [
-                word for word in words if
-                self._not_in_other_dictionaries(word, lang)
+        report = {
+            'source': post.source_path,
+            'lang': lang,
+            'dictionary': enchant.dict_exists(lang),
+            'misspellings': [],
+            'verdicts': {},
+        }
+
+        if report['dictionary']:
+            text = post.text(lang=lang, strip_html=True)
+            tokens = list(self._get_tokenizer(lang)(text))
+            misspelt, report['verdicts'] = self._check_words(
+                set(word for word, _ in tokens), lang
+            )
+            report['misspellings'] = [
+                {'word': word, 'offset': offset}
+                for word, offset in tokens if misspelt[word]
             ]
             LOGGER.notice(
                 'Mis-spelt words in %s: %s' % (
-                    post.fragment_deps(lang), ', '.join(words)
+                    post.fragment_deps(lang), ', '.join(
+                        misspelling['word']
+                        for misspelling in report['misspellings']
+                    )
                 )
             )
 
         else:
             LOGGER.notice('No dictionary found for %s' % lang)
 
+        if report_path is not None:
+            _write_json(report_path, report)
+
+    def aggregate_reports(self, report_path, dependencies, changed):
+        """ Merge the per-post reports that changed into the aggregate one.
+
+        In the aggregate report, the findings of each post are keyed by
+        its source path, then by language.  doit passes all the per-post
+        reports in dependencies, and the ones that changed since the last
+        run in changed.  Reports that are not dependencies any more are
+        dropped from the aggregate one.
+
+        The verdicts of the words first checked for the changed reports
+        are added to the verdict cache here, once for the whole build, as
+        posts may have been checked by several processes.
+
+        """
+
+        try:
+            with codecs.open(report_path, 'r', 'utf-8') as report_file:
+                aggregate = json.load(report_file)
+
+        except (IOError, ValueError):
+            aggregate = None
+
+        if (aggregate is None or
+                aggregate.get('version') != self.REPORT_VERSION):
+            aggregate = {
+                'version': self.REPORT_VERSION,
+                'posts': {},
+                # The source path and language of each per-post report
+                'report_paths': {},
+            }
+            changed = dependencies
+
+        posts = aggregate['posts']
+        report_paths = aggregate['report_paths']
+        new_verdicts = dict()
+        for path in changed:
+            with codecs.open(path, 'r', 'utf-8') as post_report:
+                report = json.load(post_report)
+            source, lang = report.pop('source'), report.pop('lang')
+            new_verdicts.setdefault(lang, dict()).update(
+                report.pop('verdicts', {})
+            )
+            posts.setdefault(source, dict())[lang] = report
+            report_paths[path] = [source, lang]
+
+        current = set(dependencies)
+        for path in list(report_paths):
+            if path not in current:
+                source, lang = report_paths.pop(path)
+                posts[source].pop(lang, None)
+                if not posts[source]:
+                    del posts[source]
+
+        aggregate['misspellings'] = sum(
+            len(report['misspellings'])
+            for langs in posts.values() for report in langs.values()
+        )
+        _write_json(report_path, aggregate)
+
+        if any(new_verdicts.values()):
+            self._save_verdicts(new_verdicts)
+
+    def _check_words(self, words, lang):
+        """ Return a dict telling if each word is mis-spelt, and a dict of
+        the verdicts that were not known yet.
+
+        Verdicts are remembered across runs, and words without one are
+        checked by a pool of threads.
+
+        """
+
+        verdicts = self._load_verdicts().setdefault(lang, {})
+        unknown = [word for word in words if word not in verdicts]
+
+        if self._workers > 1 and len(unknown) > self.CHUNK_SIZE:
+            chunks = [
+                unknown[i:i + self.CHUNK_SIZE]
+                for i in range(0, len(unknown), self.CHUNK_SIZE)
+            ]
+            results = self._get_pool().map(
+                lambda chunk: [self._is_misspelt(word, lang) for word in chunk],
+                chunks
+            )
+            new_verdicts = dict()
+            for chunk, result in zip(chunks, results):
+                new_verdicts.update(zip(chunk, result))
+
+        else:
+            new_verdicts = dict(
+                (word, self._is_misspelt(word, lang)) for word in unknown
+            )
+
+        verdicts.update(new_verdicts)
+
+        return verdicts, new_verdicts
+
+    def _get_dict(self, language):
+        """ Return the dictionary for a language.
+
+        Dictionaries are created once, for each thread using them.
+
+        """
+
+        dicts = getattr(self._local, 'dicts', None)
+        if dicts is None:
+            dicts = self._local.dicts = dict()
+
+        if language not in dicts:
+            dicts[language] = enchant.Dict(language)
+
+        return dicts[language]
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self._workers)
+
+        return self._pool
+
+    def _get_tokenizer(self, lang):
+        """ Return the tokenizer for a language, like SpellChecker does. """
+
+        if lang not in self._tokenizers:
+            filters = [EmailFilter, URLFilter]
+            try:
+                self._tokenizers[lang] = get_tokenizer(lang, filters=filters)
+            except TokenizerNotFoundError:
+                self._tokenizers[lang] = get_tokenizer(None, filters=filters)
+
+        return self._tokenizers[lang]
+
+    def _is_misspelt(self, word, lang):
+        if self._get_dict(lang).check(word):
+            return False
+
+        return self._not_in_other_dictionaries(word, lang)
+
+    def _languages(self):
+        """ Return the installed dictionaries, asking enchant only once. """
+
+        if self._langs is None:
+            self._langs = enchant.list_languages()
+
+        return self._langs
+
+    def _load_verdicts(self):
+        """ Return the verdicts cached by earlier runs. """
+
+        if self._verdicts is None:
+            self._verdicts = self._read_verdicts(self._languages())
+
+        return self._verdicts
+
+    def _read_verdicts(self, languages):
+        try:
+            with codecs.open(self._cache_path, 'r', 'utf-8') as cache_file:
+                cache = json.load(cache_file)
+
+        except (IOError, ValueError):
+            return dict()
+
+        # Installing a dictionary changes the verdicts.
+        if (cache.get('version') == self.CACHE_VERSION and
+                cache.get('languages') == languages):
+            return cache['verdicts']
+
+        return dict()
+
+    def _save_verdicts(self, new_verdicts):
+        """ Add new verdicts, by language, to the cache file. """
+
+        languages = self._languages()
+        verdicts = self._read_verdicts(languages)
+        for lang, lang_verdicts in new_verdicts.items():
+            verdicts.setdefault(lang, dict()).update(lang_verdicts)
+
+        _write_json(self._cache_path, {
+            'version': self.CACHE_VERSION,
+            'languages': languages,
+            'verdicts': verdicts,
+        })
+
     def _not_in_other_dictionaries(self, word, lang):
         """ Return True if the word is not present any dictionary for the lang.
 
         """
 
-        for language in self._langs:
+        for language in self._languages():
             if language.startswith('%s_' % lang):  # look for en_GB, en_US, ...
-                dictionary = self._dicts.setdefault(
-                    language, enchant.Dict(language)
-                )
-                if dictionary.check(word):
+                if self._get_dict(language).check(word):
                     return False
 
         return True
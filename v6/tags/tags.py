@@ -26,13 +26,20 @@
 
 from __future__ import unicode_literals, print_function
 import codecs
-from collections import defaultdict
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from hashlib import md5
+import heapq
+import json
 import math
+from multiprocessing.pool import ThreadPool
+import os
 import re
+import shutil
 from textwrap import dedent
 
 from nikola.plugin_categories import Command
-from nikola.utils import bytes_str, LOGGER, unicode_str
+from nikola.utils import bytes_str, LOGGER, makedirs, unicode_str
 
 
 def add_tags(site, tags, filenames, dry_run=False):
@@ -46,28 +53,83 @@ def add_tags(site, tags, filenames, dry_run=False):
 
     tags = _process_comma_separated_tags(tags)
 
-    posts = [post for post in site.timeline if post.source_path in filenames]
+    posts = _get_posts(site, filenames)
 
     if len(tags) == 0 or len(posts) == 0:
         print("ERROR: Need at least one tag and post.")
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
+    new_tags = _apply_tag_operations(posts, [('add', tags)], dry_run)
 
-    for post in posts:
-        new_tags = _add_tags(post.tags[:], tags)
+    return new_tags[-1]
 
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, post.tags, NEW, new_tags)
-            )
 
-        elif new_tags != post.tags:
-            _replace_tags_line(post, new_tags)
+def apply_tag_operations(site, operations, filenames, dry_run=False,
+                         workers=1):
+    """ Applies a list of tag operations to a list of posts, in one pass.
 
-    return new_tags
+        >>> ops = [('merge', 'foo,bar'), ('remove', 'baz'), ('sort', '')]
+        >>> apply_tag_operations(site, ops, filenames, workers=4)
+
+    Each operation is one of 'add', 'remove', 'merge' or 'sort', with a
+    string of comma-separated tags.  The operations are applied in
+    order, and the file of each post is rewritten at most once, using a
+    pool of threads if workers is more than one.  Returns a dictionary
+    mapping the source paths to the new tags.
+
+    """
+
+    operations = [
+        (name, _process_comma_separated_tags(tags or ''))
+        for name, tags in operations
+    ]
+
+    for name, tags in operations:
+        if name not in _TAG_OPERATIONS:
+            LOGGER.error("Unknown tag operation: %s" % name)
+            return
+
+        elif name == 'merge' and len(tags) < 2:
+            LOGGER.error("Need at least two tags to merge.")
+            return
+
+        elif name in ('add', 'remove') and len(tags) == 0:
+            LOGGER.error("Need at least one tag to %s." % name)
+            return
+
+    posts = _get_posts(site, filenames)
+
+    if len(posts) == 0:
+        LOGGER.error("Need at least one post.")
+        return
+
+    new_tags = _apply_tag_operations(posts, operations, dry_run, workers)
+
+    return dict(
+        (post.source_path, tags) for post, tags in zip(posts, new_tags)
+    )
+
+
+def auto_tag_all(site, count=5, dry_run=False, workers=1):
+    """ Automatically tags all the posts in the site, at once.
+
+        $ nikola tags --auto-tag --all
+
+    The above command scores all the words of all posts in one pass,
+    and adds the top scoring tags to each post.
+
+    """
+
+    tagger = _AutoTag(site)
+    all_tags = tagger.tag_all(count)
+
+    _apply_tag_operations(
+        site.timeline,
+        lambda post: [('add', all_tags[post.source_path])],
+        dry_run, workers
+    )
+
+    return all_tags
 
 
 def list_tags(site, sorting='alpha'):
@@ -108,28 +170,15 @@ def merge_tags(site, tags, filenames, dry_run=False):
 
     tags = _process_comma_separated_tags(tags)
 
-    posts = [post for post in site.timeline if post.source_path in filenames]
+    posts = _get_posts(site, filenames)
 
     if len(tags) < 2 or len(posts) == 0:
         print("ERROR: Need at least two tags and a post.")
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
-
-    for post in posts:
-        new_tags = _clean_tags(post.tags[:], set(tags[:-1]), tags[-1])
-
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, post.tags, NEW, new_tags)
-            )
+    new_tags = _apply_tag_operations(posts, [('merge', tags)], dry_run)
 
-        elif new_tags != post.tags:
-            _replace_tags_line(post, new_tags)
-
-    return new_tags
+    return new_tags[-1]
 
 
 def remove_tags(site, tags, filenames, dry_run=False):
@@ -143,49 +192,42 @@ def remove_tags(site, tags, filenames, dry_run=False):
 
     tags = _process_comma_separated_tags(tags)
 
-    posts = [post for post in site.timeline if post.source_path in filenames]
+    posts = _get_posts(site, filenames)
 
     if len(tags) == 0 or len(posts) == 0:
         print("ERROR: Need at least one tag and post.")
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
-
-    if len(posts) == 0:
-        new_tags = []
+    new_tags = _apply_tag_operations(posts, [('remove', tags)], dry_run)
 
-    for post in posts:
-        new_tags = _remove_tags(post.tags[:], tags)
+    return new_tags[-1]
 
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, post.tags, NEW, new_tags)
-            )
 
-        elif new_tags != post.tags:
-            _replace_tags_line(post, new_tags)
-
-    return new_tags
-
-
-def search_tags(site, term):
+def search_tags(site, term, mode='regex'):
     """ Lists all tags that match the specified search term.
 
-    The tags are sorted alphabetically, by default.
+    The tags are sorted alphabetically, by default.  With a search mode
+    of 'prefix', 'substring' or 'fuzzy', an index of the tags is used
+    instead, and the best matches are listed first.
 
     """
 
-    tags = site.posts_per_tag
-    search_re = re.compile(term.lower())
+    if mode == 'regex':
+        tags = site.posts_per_tag
+        search_re = re.compile(term.lower())
 
-    matches = [
-        tag for tag in tags
-        if term in tag.lower() or search_re.match(tag.lower())
-    ]
+        matches = [
+            tag for tag in tags
+            if term in tag.lower() or search_re.match(tag.lower())
+        ]
 
-    new_tags = sorted(matches, key=lambda tag: tag.lower())
+        new_tags = sorted(matches, key=lambda tag: tag.lower())
+
+    else:
+        new_tags = _TagIndex(site).search(term, mode)
+
+        if new_tags is None:
+            return
 
     for tag in new_tags:
         print(tag)
@@ -203,29 +245,16 @@ def sort_tags(site, filenames, dry_run=False):
 
     """
 
-    posts = [post for post in site.timeline if post.source_path in filenames]
+    posts = _get_posts(site, filenames)
 
     if len(posts) == 0:
         LOGGER.error("Need at least one post.")
 
         return
 
-    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
-    OLD = 'old'
-    NEW = 'new'
-
-    for post in posts:
-        new_tags = sorted(post.tags)
-
-        if dry_run:
-            print(FMT.format(
-                post.source_path, OLD, post.tags, NEW, new_tags)
-            )
-
-        elif new_tags != post.tags:
-            _replace_tags_line(post, new_tags)
+    new_tags = _apply_tag_operations(posts, [('sort', [])], dry_run)
 
-    return new_tags
+    return new_tags[-1]
 
 
 def _format_doc_string(function):
@@ -289,6 +318,14 @@ class CommandTags(Command):
             'type': str,
             'help': _format_doc_string(search_tags)
         },
+        {
+            'name': 'search_mode',
+            'long': 'search-mode',
+            'type': str,
+            'default': 'regex',
+            'help': 'Changes matching of search; can be one of regex, '
+                    'prefix, substring or fuzzy.\n'
+        },
         {
             'name': 'sort',
             'long': 'sort',
@@ -304,6 +341,31 @@ class CommandTags(Command):
             'type': bool,
             'help': 'Automatically tag a given set of posts.'
         },
+        {
+            'name': 'all',
+            'long': 'all',
+            'default': False,
+            'type': bool,
+            'help': _format_doc_string(auto_tag_all)
+        },
+        {
+            'name': 'count',
+            'long': 'count',
+            'default': 5,
+            'type': int,
+            'help': 'Number of tags to suggest for each post, when auto '
+                    'tagging.\n'
+        },
+        {
+            'name': 'workers',
+            'long': 'workers',
+            'default': 1,
+            'type': int,
+            'help': 'Number of threads used to rewrite the posts, when more '
+                    'than one of\n--add, --merge, --remove and --sort are '
+                    'applied together, in one pass,\nor with --auto-tag '
+                    '--all.\n'
+        },
         {
             'name': 'dry-run',
             'long': 'dry-run',
@@ -318,7 +380,20 @@ class CommandTags(Command):
     def _execute(self, options, args):
         """Manage the tags on the site."""
 
-        if len(options['add']) > 0 and len(args) > 0:
+        operations = [
+            (name, options[name]) for name in ('merge', 'remove', 'add')
+            if len(options[name]) > 0
+        ]
+        if options['sort']:
+            operations.append(('sort', ''))
+
+        if len(operations) > 1 and len(args) > 0:
+            apply_tag_operations(
+                self.site, operations, args, options['dry-run'],
+                options['workers']
+            )
+
+        elif len(options['add']) > 0 and len(args) > 0:
             add_tags(self.site, options['add'], args, options['dry-run'])
 
         elif options['list']:
@@ -331,12 +406,18 @@ class CommandTags(Command):
             remove_tags(self.site, options['remove'], args, options['dry-run'])
 
         elif len(options['search']) > 0:
-            search_tags(self.site, options['search'])
+            search_tags(self.site, options['search'], options['search_mode'])
+
+        elif options['tag'] and options['all']:
+            auto_tag_all(
+                self.site, options['count'], options['dry-run'],
+                options['workers']
+            )
 
         elif options['tag'] and len(args) > 0:
             tagger = _AutoTag(self.site)
             for post in args:
-                tags = ','.join(tagger.tag(post))
+                tags = ','.join(tagger.tag(post, options['count']))
                 add_tags(self.site, tags, [post], options['dry-run'])
 
         elif options['sort'] and len(args) > 0:
@@ -352,6 +433,7 @@ class _AutoTag(object):
     """ A class to auto tag posts, using tf-idf. """
 
     WORDS = '([A-Za-z]+[A-Za-z-]*[A-Za-z]+|[A-Za-z]+)'
+    CACHE_VERSION = 1
 
     def tag(self, post, count=5):
         """ Return a list of top tags, given a post.
@@ -370,20 +452,51 @@ class _AutoTag(object):
 
         return self._find_top_scoring_tags(post, count)
 
+    def tag_all(self, count=5):
+        """ Return a dictionary mapping each post's source path to its top tags.
+
+        The inverse document frequencies are computed once for the whole
+        vocabulary, and all the posts are scored in a single pass.
+
+        count: the number of tags to return, for each post
+
+        """
+
+        idf = dict(
+            (word, self._modified_inverse_document_frequency(word))
+            for word in self._document_frequency
+        )
+
+        top_words = self._find_top_words(idf, count)
+
+        return dict(
+            (source_path, self._get_tags_from_words(words))
+            for source_path, words in top_words.items()
+        )
+
     # ### 'object' interface ###################################################
 
-    def __init__(self, site, use_nltk=True):
+    def __init__(self, site, use_nltk=True, use_cache=True):
         """ Set up a dictionary of documents.
 
-        Each post is mapped to a list of words it contains.
+        Each post is mapped to a counter of the words it contains, and
+        the number of documents each word appears in is indexed once, so
+        that scoring a post only looks at its own vocabulary.
+
+        Unless use_cache is False, the word counts (and stems) are kept
+        in the site's CACHE_FOLDER, and only posts that changed since
+        the last run are tokenized again.
 
         """
 
         self._site = site
         self._documents = {}
+        self._document_frequency = Counter()
+        self._max_counts = {}
         self._stem_cache = {}
         self._use_nltk = use_nltk and self._nltk_available()
         self._tag_set = set([])
+        self._use_cache = use_cache
 
         if self._use_nltk:
             from nltk.corpus import stopwords
@@ -399,12 +512,21 @@ class _AutoTag(object):
         else:
             self._tag_pattern = re.compile(self.WORDS)
 
+        self._cache = self._load_cache()
         self._process_tags()
         self._process_posts()
+        self._save_cache()
         self._document_count = len(self._documents)
 
     # ### 'Private' interface ##################################################
 
+    def _cache_path(self):
+        """ Return the path of the on-disk cache file. """
+
+        name = 'auto_tag_nltk.json' if self._use_nltk else 'auto_tag.json'
+
+        return os.path.join(self._site.config['CACHE_FOLDER'], 'tags', name)
+
     def _find_stems_for_words_in_documents(self, text):
         """ Process text to get list of stems. """
 
@@ -424,20 +546,29 @@ class _AutoTag(object):
 
         for word in self._documents[post.source_path]:
             tf_idf_table[word] = self._tf_idf(word, post)
-            tags = sorted(
-                tf_idf_table, key=lambda x: tf_idf_table[x], reverse=True
-            )
 
-        if self._use_nltk:
-            tags = [
-                sorted(self._stem_word_mapping[tag], key=len)[0]
-                for tag in tags[:count]
-            ]
+        tags = sorted(
+            tf_idf_table, key=lambda x: tf_idf_table[x], reverse=True
+        )
 
-        else:
-            tags = tags[:count]
+        return self._get_tags_from_words(tags[:count])
 
-        return tags
+    def _find_top_words(self, idf, count):
+        """ Return the top scoring words of all posts. """
+
+        top_words = {}
+
+        for source_path, word_counts in self._documents.items():
+            max_count = float(self._max_count_for_path(source_path))
+            scores = dict(
+                (word, math.log(1 + word_count / max_count) * idf[word])
+                for word, word_count in word_counts.items()
+            )
+            top_words[source_path] = heapq.nlargest(
+                count, word_counts, key=scores.get
+            )
+
+        return top_words
 
     def _get_post_from_source_path(self, source):
         """ Return a post given the source path. """
@@ -461,15 +592,35 @@ class _AutoTag(object):
 
         return post_text
 
-    def _get_word_count(self, post):
-        """ Get the count of all words in a given post. """
+    def _get_words(self, text):
+        """ Return the counts of the words (or stems) in some text. """
 
-        word_counts = defaultdict(lambda: 0)
+        if not self._use_nltk:
+            words = self._tag_pattern.findall(text)
 
-        for word in self._documents[post.source_path]:
-            word_counts[word] += 1
+        else:
+            words = self._find_stems_for_words_in_documents(text)
+
+        return Counter(words)
 
-        return word_counts
+    def _get_tags_from_words(self, words):
+        """ Return the tags for a list of words (or stems, if use_nltk). """
+
+        if self._use_nltk:
+            tags = [
+                sorted(self._stem_word_mapping[word], key=len)[0]
+                for word in words
+            ]
+
+        else:
+            tags = list(words)
+
+        return tags
+
+    def _get_word_count(self, post):
+        """ Get the count of all words in a given post. """
+
+        return self._documents[post.source_path]
 
     def _get_stem_from_cache(self, word):
         """ Return the stem for a word, and cache it, if required. """
@@ -483,6 +634,48 @@ class _AutoTag(object):
 
         return stem
 
+    def _load_cache(self):
+        """ Load the cached word counts and stems, if there are any. """
+
+        cache = {}
+
+        if self._use_cache:
+            cache_path = self._cache_path()
+
+            try:
+                with codecs.open(cache_path, 'r', 'utf-8') as cache_file:
+                    cache = json.load(cache_file)
+            except (IOError, ValueError) as e:
+                LOGGER.debug(
+                    'Problem when reading `%s`: %s' % (cache_path, e)
+                )
+
+            if cache.get('version') != self.CACHE_VERSION:
+                cache = {}
+
+        if self._use_nltk:
+            for word, stem in cache.get('stems', {}).items():
+                self._stem_cache[word] = stem
+                self._stem_word_mapping[stem].add(word)
+
+        return cache
+
+    def _max_count(self, post):
+        """ Return the count of the most frequent word in a given post. """
+
+        return self._max_count_for_path(post.source_path)
+
+    def _max_count_for_path(self, source_path):
+        """ Return the count of the most frequent word, given a source path. """
+
+        if source_path not in self._max_counts:
+            word_counts = self._documents[source_path]
+            self._max_counts[source_path] = (
+                max(word_counts.values()) if word_counts else 1
+            )
+
+        return self._max_counts[source_path]
+
     def _modified_inverse_document_frequency(self, word):
         """ Gets the inverse document frequency of a word.
 
@@ -492,9 +685,7 @@ class _AutoTag(object):
         """
 
         if word not in self._tag_set:
-            count = sum(
-                1 for doc in self._documents.values() if word.lower() in doc
-            )
+            count = self._document_frequency[word.lower()]
         else:
             count = 0.25
 
@@ -512,19 +703,41 @@ class _AutoTag(object):
         return nltk is not None
 
     def _process_posts(self):
-        """ Tokenize the posts (and stem the words, if use_nltk). """
+        """ Tokenize the posts (and stem the words, if use_nltk).
+
+        A cached entry is reused when the modification time and size of
+        the source are unchanged, or when the text hashes to the same
+        value (e.g, only the tags line was edited).
+
+        """
+
+        cached_documents = self._cache.get('documents', {})
+        documents = {}
 
         for post in self._site.timeline:
+            source_path = post.source_path
+            stat = os.stat(source_path)
+            entry = cached_documents.get(source_path)
+
+            if entry is None or entry['mtime'] != stat.st_mtime or \
+                    entry['size'] != stat.st_size:
 
-            text = self._get_post_text(post)
+                text = self._get_post_text(post)
+                digest = md5(text.encode('utf-8')).hexdigest()
 
-            if not self._use_nltk:
-                words = self._tag_pattern.findall(text)
+                if entry is None or entry['hash'] != digest:
+                    entry = {'hash': digest, 'words': self._get_words(text)}
 
-            else:
-                words = self._find_stems_for_words_in_documents(text)
+                entry['mtime'] = stat.st_mtime
+                entry['size'] = stat.st_size
 
-            self._documents[post.source_path] = words
+            documents[source_path] = entry
+
+            word_counts = Counter(entry['words'])
+            self._documents[source_path] = word_counts
+            self._document_frequency.update(word_counts.keys())
+
+        self._cache['documents'] = documents
 
     def _process_tags(self):
         """ Create a tag set, to be used during tf-idf calculation. """
@@ -537,6 +750,21 @@ class _AutoTag(object):
         else:
             self._tag_set = set(self._get_stem_from_cache(tag) for tag in tags)
 
+    def _save_cache(self):
+        """ Write the word counts and stems to the on-disk cache. """
+
+        if not self._use_cache:
+            return
+
+        self._cache['version'] = self.CACHE_VERSION
+        self._cache['stems'] = self._stem_cache
+
+        cache_path = self._cache_path()
+        makedirs(os.path.dirname(cache_path))
+
+        with codecs.open(cache_path, 'w+', 'utf-8') as cache_file:
+            cache_file.write(json.dumps(self._cache))
+
     def _term_frequncy(self, word, post):
         """ Returns the frequency of a word, given a post. """
 
@@ -545,7 +773,7 @@ class _AutoTag(object):
         # A mix of augmented, logarithmic frequency.  We divide with
         # the max frequency to prevent a bias towards longer document.
         tf = math.log(
-            1 + float(word_counts[word]) / max(word_counts.values())
+            1 + float(word_counts[word]) / self._max_count(post)
         )
 
         return tf
@@ -559,6 +787,217 @@ class _AutoTag(object):
         return tf * idf
 
 
+class _TagIndex(object):
+    """ A prefix and trigram index of the tags of a site, for searching. """
+
+    CACHE_VERSION = 1
+
+    def search(self, term, mode='prefix', max_distance=None):
+        """ Return a list of tags matching the term, best matches first.
+
+        mode: one of 'prefix', 'substring' or 'fuzzy'
+        max_distance: the maximum edit distance of fuzzy matches
+
+        """
+
+        term = term.lower()
+
+        if mode == 'prefix':
+            matches = self._search_prefix(term)
+
+        elif mode == 'substring':
+            matches = self._search_substring(term)
+
+        elif mode == 'fuzzy':
+            matches = self._search_fuzzy(term, max_distance)
+
+        else:
+            LOGGER.error('Unknown search mode: %s' % mode)
+            return
+
+        return [self._tags[index] for index in matches]
+
+    # ### 'object' interface ###################################################
+
+    def __init__(self, site, use_cache=True):
+        """ Index the tags, or load the index from CACHE_FOLDER.
+
+        The tags are kept sorted, for prefix searches, and each trigram
+        is mapped to the tags that contain it.
+
+        """
+
+        self._site = site
+        self._tags = sorted(site.posts_per_tag, key=lambda tag: tag.lower())
+        self._lower_tags = [tag.lower() for tag in self._tags]
+        self._use_cache = use_cache
+        self._digest = md5(
+            '\n'.join(self._tags).encode('utf-8')
+        ).hexdigest()
+
+        self._trigrams = self._load_cache()
+
+        if self._trigrams is None:
+            self._trigrams = self._build_index()
+            self._save_cache()
+
+    # ### 'Private' interface ##################################################
+
+    def _build_index(self):
+        """ Return a dictionary mapping trigrams to indices of tags. """
+
+        trigrams = defaultdict(list)
+
+        for index, tag in enumerate(self._lower_tags):
+            for trigram in self._get_trigrams(tag):
+                trigrams[trigram].append(index)
+
+        return dict(trigrams)
+
+    def _cache_path(self):
+        """ Return the path of the on-disk cache file. """
+
+        return os.path.join(
+            self._site.config['CACHE_FOLDER'], 'tags', 'search_index.json'
+        )
+
+    @staticmethod
+    def _get_trigrams(text, padded=True):
+        """ Return the set of trigrams in some text.
+
+        Padding the text makes short words have trigrams too, and gives
+        more weight to the start of words.
+
+        """
+
+        if padded:
+            text = '  ' + text + ' '
+
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def _load_cache(self):
+        """ Return the cached trigrams, if they are for the same tags. """
+
+        if not self._use_cache:
+            return
+
+        cache_path = self._cache_path()
+
+        try:
+            with codecs.open(cache_path, 'r', 'utf-8') as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            LOGGER.debug('Problem when reading `%s`: %s' % (cache_path, e))
+            return
+
+        if cache.get('version') == self.CACHE_VERSION and \
+                cache.get('digest') == self._digest:
+            return cache['trigrams']
+
+    def _save_cache(self):
+        """ Write the trigrams to the on-disk cache. """
+
+        if not self._use_cache:
+            return
+
+        cache = {
+            'version': self.CACHE_VERSION,
+            'digest': self._digest,
+            'trigrams': self._trigrams,
+        }
+
+        cache_path = self._cache_path()
+        makedirs(os.path.dirname(cache_path))
+
+        with codecs.open(cache_path, 'w+', 'utf-8') as cache_file:
+            cache_file.write(json.dumps(cache))
+
+    def _search_fuzzy(self, term, max_distance):
+        """ Return indices of tags within an edit distance of the term.
+
+        An edit changes at most three trigrams, so only the tags sharing
+        enough trigrams with the term need to be compared with it.
+
+        """
+
+        if max_distance is None:
+            max_distance = max(1, len(term) // 3)
+
+        trigrams = self._get_trigrams(term)
+        min_shared = len(trigrams) - 3 * max_distance
+
+        if min_shared > 0:
+            shared = Counter()
+            for trigram in trigrams:
+                shared.update(self._trigrams.get(trigram, []))
+            candidates = [
+                index for index, count in shared.items()
+                if count >= min_shared
+            ]
+
+        else:
+            candidates = range(len(self._tags))
+
+        distances = {}
+
+        for index in candidates:
+            tag = self._lower_tags[index]
+            if abs(len(tag) - len(term)) <= max_distance:
+                distance = _edit_distance(term, tag, max_distance)
+                if distance <= max_distance:
+                    distances[index] = distance
+
+        return sorted(distances, key=lambda index: (distances[index], index))
+
+    def _search_prefix(self, term):
+        """ Return indices of tags starting with the term, shortest first. """
+
+        matches = []
+        index = bisect_left(self._lower_tags, term)
+
+        while index < len(self._tags) and \
+                self._lower_tags[index].startswith(term):
+            matches.append(index)
+            index += 1
+
+        return sorted(
+            matches, key=lambda index: (len(self._tags[index]), index)
+        )
+
+    def _search_substring(self, term):
+        """ Return indices of tags containing the term.
+
+        Tags where the term is found earlier, and shorter tags, come
+        first.
+
+        """
+
+        trigrams = self._get_trigrams(term, padded=False)
+
+        if len(trigrams) > 0:
+            postings = sorted(
+                (self._trigrams.get(trigram, []) for trigram in trigrams),
+                key=len
+            )
+            candidates = set(postings[0]).intersection(*postings[1:])
+
+        else:
+            candidates = range(len(self._tags))
+
+        matches = [
+            index for index in candidates if term in self._lower_tags[index]
+        ]
+
+        return sorted(
+            matches,
+            key=lambda index: (
+                self._lower_tags[index].find(term),
+                len(self._tags[index]),
+                index
+            )
+        )
+
+
 def _add_tags(tags, additions):
     """ In all tags list, add tags in additions if not already present. """
 
@@ -569,6 +1008,56 @@ def _add_tags(tags, additions):
     return tags
 
 
+def _apply_tag_operations(posts, operations, dry_run=False, workers=1):
+    """ Apply the tag operations to posts, and return the new tags of each.
+
+    operations is a list of (name, tags) pairs, or a function returning
+    that list for a post.  The files of the changed posts are rewritten
+    once, after all the operations have been applied.
+
+    """
+
+    FMT = 'Tags for {0}:\n{1:>6} - {2}\n{3:>6} - {4}\n'
+    OLD = 'old'
+    NEW = 'new'
+
+    all_new_tags = []
+    changed = []
+
+    for post in posts:
+        new_tags = post.tags[:]
+        post_operations = (
+            operations(post) if callable(operations) else operations
+        )
+
+        for name, tags in post_operations:
+            new_tags = _TAG_OPERATIONS[name](new_tags, tags)
+
+        all_new_tags.append(new_tags)
+
+        if dry_run:
+            print(FMT.format(
+                post.source_path, OLD, post.tags, NEW, new_tags)
+            )
+
+        elif new_tags != post.tags:
+            changed.append((post, new_tags))
+
+    if workers > 1 and len(changed) > 1:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda args: _replace_tags_line(*args), changed)
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        for post, new_tags in changed:
+            _replace_tags_line(post, new_tags)
+
+    return all_new_tags
+
+
 def _clean_tags(tags, remove, keep):
     """ In all tags list, replace tags in remove with keep tag. """
     original_tags = tags[:]
@@ -582,6 +1071,48 @@ def _clean_tags(tags, remove, keep):
     return tags
 
 
+def _edit_distance(first, second, max_distance):
+    """ Return the Levenshtein distance between two strings.
+
+    The computation stops early, returning max_distance + 1, as soon as
+    the distance is known to be larger than max_distance.
+
+    """
+
+    previous = list(range(len(second) + 1))
+
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+
+        for j, second_char in enumerate(second, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (first_char != second_char)
+            ))
+
+        if min(current) > max_distance:
+            return max_distance + 1
+
+        previous = current
+
+    return previous[-1]
+
+
+def _get_posts(site, filenames):
+    """ Return the posts of the site (in timeline order) given filenames. """
+
+    filenames = set(filenames)
+
+    return [post for post in site.timeline if post.source_path in filenames]
+
+
+def _merge_tags(tags, merges):
+    """ In all tags list, replace all but the last tag in merges with it. """
+
+    return _clean_tags(tags, set(merges[:-1]), merges[-1])
+
+
 def _process_comma_separated_tags(tags):
     """ Return a list of tags given a string of comma-separated tags. """
     return [tag.strip() for tag in tags.strip().split(',') if tag.strip()]
@@ -622,5 +1153,33 @@ def _replace_tags_line(post, tags):
             post_text[index] = new_tags
             break
 
-    with codecs.open(source_path, 'w+', 'utf-8') as f:
+    # Write to a temporary file first, so that the post is never left
+    # half-written.
+    temp_path = source_path + '.tags-tmp'
+
+    with codecs.open(temp_path, 'w+', 'utf-8') as f:
         f.writelines(post_text)
+
+    shutil.copymode(source_path, temp_path)
+
+    if hasattr(os, 'replace'):
+        os.replace(temp_path, source_path)
+
+    else:
+        if os.name == 'nt':
+            os.remove(source_path)
+        os.rename(temp_path, source_path)
+
+
+def _sort_tags(tags, unused):
+    """ Return the tags sorted alphabetically. """
+
+    return sorted(tags)
+
+
+_TAG_OPERATIONS = {
+    'add': _add_tags,
+    'merge': _merge_tags,
+    'remove': _remove_tags,
+    'sort': _sort_tags,
+}
@@ -85,9 +85,20 @@ class CommandImportFeed(Command, ImportMixin):
         self.write_configuration(self.get_configuration_output_path(
         ), conf_template.render(**prepare_config(self.context)))
 
-    @classmethod
-    def get_channel_from_file(cls, filename):
-        return feedparser.parse(filename)
+    def get_channel_from_file(self, filename):
+        # Big dumps are parsed one entry at a time by the planetoid plugin,
+        # if it is installed, to keep memory use low.  Feeds that are not
+        # well formed XML need feedparser's more lenient parsing.
+        # URLs are left to feedparser.
+        planetoid = self.site.plugin_manager.getPluginByName('planetoid', 'Command')
+        if planetoid is None or not os.path.isfile(filename):
+            return feedparser.parse(filename)
+        try:
+            return planetoid.plugin_object.iter_feed(filename)
+        except SyntaxError as e:
+            LOGGER.warn("Can't parse {0} incrementally ({1}), loading it "
+                        "all at once.".format(filename, e))
+            return feedparser.parse(filename)
 
     @staticmethod
     def populate_context(channel):
@@ -28,7 +28,10 @@ from __future__ import unicode_literals
 
 import codecs
 import glob
+import hashlib
+import json
 import os
+import re
 import sys
 import subprocess
 
@@ -36,6 +39,96 @@ from nikola.plugin_categories import Task
 from nikola import utils
 
 
+# @import rules, with their options and the imported file, either quoted
+# or in a (quoted or not) url()
+IMPORT_RE = re.compile(r'@import\s*(\([^)]*\))?\s*'
+                       r'(?:[\'"]([^\'"]+)[\'"]|url\(\s*[\'"]?([^\'")]+?)[\'"]?\s*\))')
+
+
+def parse_imports(path):
+    """Return the LESS files imported by a LESS file, as written in it."""
+    with codecs.open(path, "rb", "utf-8") as inf:
+        data = inf.read()
+    names = []
+    for options, quoted, url in IMPORT_RE.findall(data):
+        name = quoted or url
+        options = set(re.findall(r'[\w-]+', options))
+        if name.startswith(('http://', 'https://', '//')):
+            continue
+        # .css files are left as CSS imports, unless told otherwise, and
+        # so is anything imported with the css option
+        if 'css' in options:
+            continue
+        if name.endswith('.css') and not options & set(['less', 'inline']):
+            continue
+        names.append(name)
+    return names
+
+
+class ImportGraph(object):
+    """The imports between LESS files, with the imports of each file
+    cached by its modification time."""
+
+    CACHE_VERSION = 2
+
+    def __init__(self, sources, cache_path):
+        # sources maps paths relative to the sources folder to real paths
+        self.sources = sources
+        self.cache_path = cache_path
+        self._changed = False
+        self._cache = {}
+        try:
+            with codecs.open(cache_path, "rb", "utf-8") as inf:
+                cache = json.load(inf)
+            if cache.get('version') == self.CACHE_VERSION:
+                self._cache = cache['files']
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        if not self._changed:
+            return
+        utils.makedirs(os.path.dirname(self.cache_path))
+        with codecs.open(self.cache_path, "wb+", "utf-8") as outf:
+            outf.write(json.dumps({'version': self.CACHE_VERSION,
+                                   'files': self._cache}))
+        self._changed = False
+
+    def names(self, name):
+        """Return the names imported by a source file."""
+        path = self.sources[name]
+        mtime = os.stat(path).st_mtime
+        cached = self._cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self._cache[path] = [mtime, parse_imports(path)]
+            self._changed = True
+        return cached[1]
+
+    def resolve(self, name, imported):
+        """Return the source file an import refers to, or None."""
+        imported = imported.replace('/', os.sep)
+        if not os.path.splitext(imported)[1]:
+            imported += '.less'
+        for folder in (os.path.dirname(name), ''):
+            candidate = os.path.normpath(os.path.join(folder, imported))
+            if candidate in self.sources:
+                return candidate
+        return None
+
+    def dependencies(self, name):
+        """Return all the source files a file imports, directly or not."""
+        seen = set()
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            for imported in self.names(current):
+                dep = self.resolve(current, imported)
+                if dep is not None and dep not in seen and dep != name:
+                    seen.add(dep)
+                    pending.append(dep)
+        return sorted(seen)
+
+
 class BuildLess(Task):
     """Generate CSS out of LESS sources."""
 
@@ -77,33 +170,77 @@ class BuildLess(Task):
         for theme_name in kw['themes']:
             src = os.path.join(utils.get_theme_path(theme_name), self.sources_folder)
             for task in utils.copy_tree(src, os.path.join(kw['cache_folder'], self.sources_folder)):
+                if task['name'] in tasks:
+                    continue
                 task['basename'] = 'prepare_less_sources'
+                tasks[task['name']] = task
                 yield task
 
         # Build targets and write CSS files
-        base_path = utils.get_theme_path(self.site.THEMES[0])
         dst_dir = os.path.join(self.site.config['OUTPUT_FOLDER'], 'assets', 'css')
-        # Make everything depend on all sources, rough but enough
-        deps = []
-        if os.path.isfile(os.path.join(self.sources_folder, "targets")):
-            deps += glob.glob(os.path.join(kw['cache_folder'], self.sources_folder,
-                                           '*{0}'.format(self.sources_ext)))
-        else:
-            deps += glob.glob(os.path.join(base_path, self.sources_folder,
-                                           '*{0}'.format(self.sources_ext)))
+        # Each target depends on the sources it imports, directly or not
+        sources = {}
+        for folder in [self.sources_folder] + [
+                os.path.join(utils.get_theme_path(theme_name), self.sources_folder)
+                for theme_name in kw['themes']]:
+            for root, dirs, files in os.walk(folder):
+                for fname in files:
+                    if os.path.splitext(fname)[1] not in (self.sources_ext, '.css'):
+                        continue
+                    path = os.path.join(root, fname)
+                    sources.setdefault(os.path.relpath(path, folder), path)
+        graph = ImportGraph(sources,
+                            os.path.join(kw['cache_folder'], self.name, 'imports.json'))
 
-        def compile_target(target, dst):
-            utils.makedirs(dst_dir)
+        def get_deps(target):
+            if target in sources:
+                names = [target] + graph.dependencies(target)
+            else:
+                names = sorted(sources)
+            return [os.path.join(kw['cache_folder'], self.sources_folder, x)
+                    for x in names]
+
+        kw['options'] = self.compiler_options
+        output_cache = os.path.join(kw['cache_folder'], self.name, 'css')
+        all_deps = dict((target, get_deps(target)) for target in targets)
+
+        def output_cache_path(target):
+            """Return the path of the cached CSS for a target, keyed by the
+            contents of its sources, the compiler and its options."""
+            h = hashlib.sha1()
+            h.update(json.dumps([self.compiler_name, self.compiler_options]).encode('utf-8'))
+            for dep in all_deps[target]:
+                h.update(dep.encode('utf-8'))
+                with open(dep, 'rb') as inf:
+                    h.update(hashlib.sha1(inf.read()).digest())
+            return os.path.join(output_cache, os.path.splitext(target)[0],
+                                h.hexdigest() + '.css')
+
+        def run_compiler(target):
             src = os.path.join(kw['cache_folder'], self.sources_folder, target)
             run_in_shell = sys.platform == 'win32'
+            return subprocess.check_output([self.compiler_name] + self.compiler_options + [src], shell=run_in_shell)
+
+        def compile_target(target, dst):
+            utils.makedirs(dst_dir)
+            cache_path = output_cache_path(target)
+            if os.path.isfile(cache_path):
+                utils.copy_file(cache_path, dst)
+                return
             try:
-                compiled = subprocess.check_output([self.compiler_name] + self.compiler_options + [src], shell=run_in_shell)
+                compiled = run_compiler(target)
             except OSError:
                 utils.req_missing([self.compiler_name],
                                   'build LESS files (and use this theme)',
                                   False, False)
             with open(dst, "wb+") as outf:
                 outf.write(compiled)
+            # Keep only the latest CSS of each target in the cache
+            utils.makedirs(os.path.dirname(cache_path))
+            for old in glob.glob(os.path.join(os.path.dirname(cache_path), '*.css')):
+                os.remove(old)
+            with open(cache_path, "wb+") as outf:
+                outf.write(compiled)
 
         yield self.group_task()
 
@@ -113,9 +250,11 @@ class BuildLess(Task):
                 'basename': self.name,
                 'name': dst,
                 'targets': [dst],
-                'file_dep': deps,
+                'file_dep': all_deps[target],
                 'task_dep': ['prepare_less_sources'],
                 'actions': ((compile_target, [target, dst]), ),
                 'uptodate': [utils.config_changed(kw)],
                 'clean': True
             }
+
+        graph.save()
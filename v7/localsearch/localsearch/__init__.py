@@ -25,11 +25,18 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from __future__ import unicode_literals
+import binascii
 import codecs
+import hashlib
 import json
 import os
+import re
+import zlib
 
-from doit.tools import result_dep
+try:
+    import brotli
+except ImportError:
+    brotli = None  # NOQA
 
 from nikola.plugin_categories import LateTask
 from nikola.utils import config_changed, copy_tree, makedirs
@@ -61,28 +68,83 @@ class Tipue(LateTask):
         kw = {
             "translations": self.site.config['TRANSLATIONS'],
             "output_folder": self.site.config['OUTPUT_FOLDER'],
+            "cache_folder": self.site.config['CACHE_FOLDER'],
+            "sharded": self.site.config.get('LOCAL_SEARCH_SHARDED', False),
+            "shard_prefix_length": self.site.config.get(
+                'LOCAL_SEARCH_SHARD_PREFIX_LENGTH', 2),
+            "compact": self.site.config.get('LOCAL_SEARCH_COMPACT', False),
+            "text_length": self.site.config.get('LOCAL_SEARCH_TEXT_LENGTH', None),
         }
 
         posts = self.site.timeline[:]
-        dst_path = os.path.join(kw["output_folder"], "assets", "js",
-                                "tipuesearch_content.json")
+        extra_targets = []
+        if kw["sharded"]:
+            shards_folder = os.path.join(kw["output_folder"], "assets", "js",
+                                         "tipuesearch_shards")
+            dst_path = os.path.join(shards_folder, "manifest.json")
+            state_path = os.path.join(kw["cache_folder"], "localsearch",
+                                      "shards.json")
+            extra_targets = shard_paths(state_path, shards_folder,
+                                        kw["shard_prefix_length"])
+        elif kw["compact"]:
+            dst_path = os.path.join(kw["output_folder"], "assets", "js",
+                                    "tipuesearch_content.compact.json")
+            extra_targets = precompressed_paths(dst_path)
+        else:
+            dst_path = os.path.join(kw["output_folder"], "assets", "js",
+                                    "tipuesearch_content.json")
+
+        def save_record(post, lang, record_path):
+            text = post.text(lang, strip_html=True)
+            text = text.replace('^', '')
+
+            data = {}
+            data["title"] = post.title(lang)
+            data["text"] = text
+            data["tags"] = ",".join(post.tags)
+            data["loc"] = post.permalink(lang)
+            makedirs(os.path.dirname(record_path))
+            with codecs.open(record_path, "wb+", "utf8") as fd:
+                fd.write(json.dumps(data))
+
+        # Extract the search record of each post, in each language, to
+        # the cache, so that editing a post only extracts that post again.
+        record_paths = []
+        for lang in kw["translations"]:
+            for post in posts:
+                # Don't index drafts (Issue #387)
+                if post.is_draft or post.is_private or post.publish_later:
+                    continue
+                record_name = hashlib.md5(post.source_path.encode('utf8')).hexdigest()
+                record_path = os.path.join(kw["cache_folder"], "localsearch",
+                                           "records", lang, record_name + ".json")
+                record_paths.append(record_path)
+                yield {
+                    "basename": str(self.name),
+                    "name": record_path,
+                    "file_dep": post.fragment_deps(lang),
+                    "targets": [record_path],
+                    "actions": [(save_record, (post, lang, record_path))],
+                    "uptodate": [config_changed({
+                        1: post.title(lang),
+                        2: post.tags,
+                        3: post.permalink(lang),
+                    })],
+                    "clean": True,
+                }
 
         def save_data():
             pages = []
-            for lang in kw["translations"]:
-                for post in posts:
-                    # Don't index drafts (Issue #387)
-                    if post.is_draft or post.is_private or post.publish_later:
-                        continue
-                    text = post.text(lang, strip_html=True)
-                    text = text.replace('^', '')
-
-                    data = {}
-                    data["title"] = post.title(lang)
-                    data["text"] = text
-                    data["tags"] = ",".join(post.tags)
-                    data["loc"] = post.permalink(lang)
-                    pages.append(data)
+            for record_path in record_paths:
+                with codecs.open(record_path, "rb", "utf8") as fd:
+                    pages.append(json.load(fd))
+            if kw["sharded"]:
+                write_shards(pages, shards_folder, state_path,
+                             kw["shard_prefix_length"])
+                return
+            if kw["compact"]:
+                write_compact(pages, dst_path, kw["text_length"])
+                return
             output = json.dumps({"pages": pages}, indent=2)
             makedirs(os.path.dirname(dst_path))
             with codecs.open(dst_path, "wb+", "utf8") as fd:
@@ -91,16 +153,214 @@ class Tipue(LateTask):
         yield {
             "basename": str(self.name),
             "name": dst_path,
-            "targets": [dst_path],
+            "file_dep": record_paths,
+            "targets": [dst_path] + extra_targets,
             "actions": [(save_data, [])],
-            'uptodate': [config_changed(kw), result_dep('sitemap')]
+            "clean": True,
+            # The list of records changes when posts are added or removed.
+            'uptodate': [config_changed(dict(kw, record_paths=record_paths))]
         }
-        # Note: The task should run everytime a new file is added or a
-        # file is changed.  We cheat, and depend on the sitemap task,
-        # to run everytime a new file is added.
 
         # Copy all the assets to the right places
         asset_folder = os.path.join(os.path.dirname(__file__), "files")
         for task in copy_tree(asset_folder, kw["output_folder"]):
             task["basename"] = str(self.name)
             yield task
+
+
+# In sharded mode, we produce an inverted index instead, split in
+# shards by the first letters of the terms:
+#
+# manifest.json:
+#     {"prefix_length": 2,
+#      "docs": {"0": {"title": "Tipue Search demo", "tags": "JavaScript",
+#                     "loc": "http://www.tipue.com/search/demo"}, ...},
+#      "shards": {"ti": {"file": "7469.json", "hash": "5d41402a"}, ...}}
+#
+# 7469.json:
+#     {"tipue": [[0, 12], [3, 1]], "title": [[1, 10]]}
+#
+# Each term maps to a list of [doc id, weight] pairs.  Doc ids are kept
+# stable across builds in CACHE_FOLDER, so that only the shards with
+# terms of new, changed or removed pages are rewritten.
+
+SHARDS_VERSION = 1
+TERMS_RE = re.compile(r'\w+', re.UNICODE)
+TITLE_WEIGHT = 10
+TAGS_WEIGHT = 5
+
+
+def get_terms(page):
+    """Return a dictionary mapping the terms in a page to their weights."""
+    terms = {}
+    for field, weight in (("title", TITLE_WEIGHT), ("tags", TAGS_WEIGHT),
+                          ("text", 1)):
+        for term in TERMS_RE.findall(page[field].lower()):
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+def load_shards_state(state_path, prefix_length):
+    """Return the state of the shards written by the last build."""
+    try:
+        with codecs.open(state_path, "rb", "utf8") as fd:
+            state = json.load(fd)
+    except (IOError, ValueError):
+        state = {}
+    if (state.get("version") != SHARDS_VERSION or
+            state.get("prefix_length") != prefix_length):
+        state = {"version": SHARDS_VERSION, "prefix_length": prefix_length,
+                 "next_id": 0, "docs": {}, "shards": {}}
+    return state
+
+
+def shard_paths(state_path, shards_folder, prefix_length):
+    """Return the paths of the shards written by the last build."""
+    state = load_shards_state(state_path, prefix_length)
+    return sorted(os.path.join(shards_folder, shard["file"])
+                  for shard in state["shards"].values())
+
+
+def write_shards(pages, shards_folder, state_path, prefix_length):
+    """Write the sharded inverted index of pages, and its manifest."""
+    state = load_shards_state(state_path, prefix_length)
+
+    old_docs = state["docs"]
+    docs = {}
+    if os.path.exists(os.path.join(shards_folder, "manifest.json")):
+        # Shards removed from the output folder are written again
+        affected = set(
+            prefix for prefix, shard in state["shards"].items()
+            if not os.path.exists(os.path.join(shards_folder, shard["file"])))
+    else:
+        # The output folder was wiped, write all the shards again
+        affected = set(state["shards"])
+    for page in pages:
+        digest = hashlib.md5(json.dumps(
+            page, sort_keys=True).encode('utf8')).hexdigest()
+        doc = old_docs.pop(page["loc"], None)
+        if doc is None or doc["hash"] != digest:
+            terms = get_terms(page)
+            if doc is None:
+                doc = {"id": state["next_id"]}
+                state["next_id"] += 1
+            else:
+                affected.update(term[:prefix_length] for term in doc["terms"])
+            affected.update(term[:prefix_length] for term in terms)
+            doc.update({"hash": digest, "terms": terms, "title": page["title"],
+                        "tags": page["tags"]})
+        docs[page["loc"]] = doc
+    # Whatever is left was removed from the site.
+    for doc in old_docs.values():
+        affected.update(term[:prefix_length] for term in doc["terms"])
+    state["docs"] = docs
+
+    shards = dict((prefix, {}) for prefix in affected)
+    for doc in docs.values():
+        for term, weight in doc["terms"].items():
+            prefix = term[:prefix_length]
+            if prefix in shards:
+                shards[prefix].setdefault(term, []).append([doc["id"], weight])
+
+    makedirs(shards_folder)
+    for prefix, shard in shards.items():
+        file_name = binascii.hexlify(prefix.encode('utf8')).decode('ascii') + ".json"
+        shard_path = os.path.join(shards_folder, file_name)
+        if not shard:
+            state["shards"].pop(prefix, None)
+            if os.path.exists(shard_path):
+                os.unlink(shard_path)
+            continue
+        for postings in shard.values():
+            postings.sort()
+        output = json.dumps(shard, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.md5(output.encode('utf8')).hexdigest()[:8]
+        if (state["shards"].get(prefix, {}).get("hash") == digest and
+                os.path.exists(shard_path)):
+            continue
+        with codecs.open(shard_path, "wb+", "utf8") as fd:
+            fd.write(output)
+        state["shards"][prefix] = {"file": file_name, "hash": digest}
+
+    manifest = {
+        "prefix_length": prefix_length,
+        "docs": dict((doc["id"], {"title": doc["title"], "tags": doc["tags"],
+                                  "loc": loc})
+                     for loc, doc in docs.items()),
+        "shards": state["shards"],
+    }
+    with codecs.open(os.path.join(shards_folder, "manifest.json"), "wb+", "utf8") as fd:
+        fd.write(json.dumps(manifest, sort_keys=True, separators=(',', ':')))
+
+    makedirs(os.path.dirname(state_path))
+    with codecs.open(state_path, "wb+", "utf8") as fd:
+        fd.write(json.dumps(state))
+
+
+# In compact mode, we produce the same pages with no whitespace, and with
+# the tags and the URL prefixes stored once, in lookup tables:
+#
+#     {"tags": ["JavaScript", ...],
+#      "prefixes": ["http://www.tipue.com/", ...],
+#      "pages": [["Tipue Search demo", "Tipue Search demo. Tipue...",
+#                 [0], 0, "search/demo"], ...]}
+#
+# Each page is [title, text, tag ids, prefix id, rest of the URL].
+# tipuesearch_compact.js expands it back for Tipue's "static" mode.  The
+# file is also written gzipped (and brotli compressed, if the brotli
+# module is available), so servers can send it precompressed.
+
+
+def compact_pages(pages, text_length=None):
+    """Return the compact form of pages, optionally truncating the text."""
+    tags = []
+    tag_ids = {}
+    prefixes = []
+    prefix_ids = {}
+    compact = []
+    for page in pages:
+        page_tags = []
+        for tag in page["tags"].split(","):
+            if not tag:
+                continue
+            if tag not in tag_ids:
+                tag_ids[tag] = len(tags)
+                tags.append(tag)
+            page_tags.append(tag_ids[tag])
+        prefix = page["loc"].rstrip("/").rsplit("/", 1)[0] + "/"
+        rest = page["loc"][len(prefix):]
+        if prefix not in prefix_ids:
+            prefix_ids[prefix] = len(prefixes)
+            prefixes.append(prefix)
+        text = page["text"]
+        if text_length is not None and len(text) > text_length:
+            # Cut on a word boundary
+            text = (text[:text_length].rsplit(None, 1) or [""])[0]
+        compact.append([page["title"], text, page_tags, prefix_ids[prefix],
+                        rest])
+    return {"tags": tags, "prefixes": prefixes, "pages": compact}
+
+
+def precompressed_paths(path):
+    """Return the paths of the precompressed siblings of path."""
+    paths = [path + ".gz"]
+    if brotli is not None:
+        paths.append(path + ".br")
+    return paths
+
+
+def write_compact(pages, dst_path, text_length=None):
+    """Write the compact JSON of pages, and its precompressed siblings."""
+    output = json.dumps(compact_pages(pages, text_length), ensure_ascii=False,
+                        separators=(',', ':')).encode('utf8')
+    makedirs(os.path.dirname(dst_path))
+    with open(dst_path, "wb+") as fd:
+        fd.write(output)
+    # A gzip stream written by zlib, with no file name or time in its
+    # header, so that it only changes when the JSON does.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(dst_path + ".gz", "wb+") as fd:
+        fd.write(compressor.compress(output) + compressor.flush())
+    if brotli is not None:
+        with open(dst_path + ".br", "wb+") as fd:
+            fd.write(brotli.compress(output))
@@ -0,0 +1,40 @@
+/*
+Loader for the compact search data written by the Nikola localsearch
+plugin, when LOCAL_SEARCH_COMPACT is True.  It expands the data to the
+format Tipue Search uses in its "static" mode:
+
+     var tipuesearch = tipuesearch_compact('/assets/js/tipuesearch_content.compact.json');
+     $('#tipue_search_input').tipuesearch({'mode': 'static'});
+*/
+
+
+function tipuesearch_compact(location)
+{
+     var tipuesearch = {"pages": []};
+
+     $.ajax({
+          url: location,
+          dataType: 'json',
+          async: false,
+          success: function(data)
+          {
+               for (var i = 0; i < data.pages.length; i++)
+               {
+                    var page = data.pages[i];
+                    var tags = [];
+                    for (var t = 0; t < page[2].length; t++)
+                    {
+                         tags.push(data.tags[page[2][t]]);
+                    }
+                    tipuesearch.pages.push({
+                         "title": page[0],
+                         "text": page[1],
+                         "tags": tags.join(','),
+                         "loc": data.prefixes[page[3]] + page[4]
+                    });
+               }
+          }
+     });
+
+     return tipuesearch;
+}
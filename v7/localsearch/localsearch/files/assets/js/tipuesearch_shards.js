@@ -0,0 +1,182 @@
+/*
+Client for the sharded search index written by the Nikola localsearch
+plugin, when LOCAL_SEARCH_SHARDED is True.  Only the manifest and the
+shards for the terms in a query are downloaded.
+
+Results are shown in #tipue_search_content, using the same markup (and
+CSS) as Tipue Search.
+*/
+
+
+(function($) {
+
+     $.fn.tipuesearchshards = function(options) {
+
+          var set = $.extend( {
+
+               'show'                   : 10,
+               'minimumLength'          : 2,
+               'indexLocation'          : '/assets/js/tipuesearch_shards/'
+
+          }, options);
+
+          var manifest = null;
+          var shards = {};
+
+          function getManifest(callback)
+          {
+               if (manifest)
+               {
+                    callback(manifest);
+                    return;
+               }
+               $.getJSON(set.indexLocation + 'manifest.json', function(json)
+               {
+                    manifest = json;
+                    callback(manifest);
+               });
+          }
+
+          function getShards(prefixes, callback)
+          {
+               var missing = $.grep(prefixes, function(prefix)
+               {
+                    return manifest.shards[prefix] && !shards[prefix];
+               });
+               var pending = missing.length;
+               if (pending == 0)
+               {
+                    callback();
+                    return;
+               }
+               $.each(missing, function(i, prefix)
+               {
+                    var shard = manifest.shards[prefix];
+                    $.getJSON(set.indexLocation + shard.file + '?v=' + shard.hash, function(json)
+                    {
+                         shards[prefix] = json;
+                    }).always(function()
+                    {
+                         pending -= 1;
+                         if (pending == 0)
+                         {
+                              callback();
+                         }
+                    });
+               });
+          }
+
+          // Return an object mapping doc ids to the weight of the term
+          // in them.  Terms at least as long as the shard prefixes also
+          // match longer terms starting with them.
+          function findTerm(term)
+          {
+               var found = {};
+               var shard = shards[term.substr(0, manifest.prefix_length)] || {};
+               $.each(shard, function(shardTerm, postings)
+               {
+                    if (shardTerm == term ||
+                        (term.length >= manifest.prefix_length && shardTerm.indexOf(term) == 0))
+                    {
+                         $.each(postings, function(i, posting)
+                         {
+                              found[posting[0]] = (found[posting[0]] || 0) + posting[1];
+                         });
+                    }
+               });
+               return found;
+          }
+
+          function search(query, output)
+          {
+               var terms = $.grep(query.toLowerCase().split(/[\s!-\/:-@\[-\^`{-~]+/), function(term)
+               {
+                    return term.length > 0;
+               });
+               if (query.length < set.minimumLength || terms.length == 0)
+               {
+                    output.html('<div id="tipue_search_warning_head">Search too short</div>');
+                    return;
+               }
+               getManifest(function()
+               {
+                    var prefixes = $.map(terms, function(term)
+                    {
+                         return term.substr(0, manifest.prefix_length);
+                    });
+                    getShards(prefixes, function()
+                    {
+                         // Every term in the query must be found in a page.
+                         var scores = findTerm(terms[0]);
+                         for (var i = 1; i < terms.length; i++)
+                         {
+                              var found = findTerm(terms[i]);
+                              $.each(scores, function(id)
+                              {
+                                   if (found[id] === undefined)
+                                   {
+                                        delete scores[id];
+                                   }
+                                   else
+                                   {
+                                        scores[id] += found[id];
+                                   }
+                              });
+                         }
+                         var ids = $.map(scores, function(score, id)
+                         {
+                              return id;
+                         });
+                         ids.sort(function(a, b)
+                         {
+                              return scores[b] - scores[a];
+                         });
+                         render(ids, output);
+                    });
+               });
+          }
+
+          function render(ids, output)
+          {
+               var out = '';
+               if (ids.length == 0)
+               {
+                    out += '<div id="tipue_search_warning_head">Nothing found</div>';
+               }
+               else
+               {
+                    out += '<div id="tipue_search_results_count">' + ids.length + ' results</div>';
+               }
+               $.each(ids.slice(0, set.show), function(i, id)
+               {
+                    var doc = manifest.docs[id];
+                    out += '<div class="tipue_search_content_title"><a href="' + doc.loc + '">' +
+                         $('<div/>').text(doc.title).html() + '</a></div>';
+                    if (doc.tags)
+                    {
+                         out += '<div class="tipue_search_content_text">' +
+                              $('<div/>').text(doc.tags).html() + '</div>';
+                    }
+               });
+               output.html(out);
+          }
+
+          return this.each(function() {
+
+               var input = $(this);
+               input.keyup(function(event)
+               {
+                    if (event.keyCode == '13')
+                    {
+                         search(input.val(), $('#tipue_search_content'));
+                    }
+               });
+               $('#tipue_search_button').click(function()
+               {
+                    search(input.val(), $('#tipue_search_content'));
+               });
+
+          });
+     };
+
+})(jQuery);
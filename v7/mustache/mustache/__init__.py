@@ -27,12 +27,18 @@
 from __future__ import unicode_literals
 
 import codecs
+import hashlib
 import json
 import os
 
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit  # NOQA
+
 from nikola.plugin_categories import Task
 from nikola.utils import (
-    config_changed, copy_file, LocaleBorg, makedirs, unicode_str,
+    config_changed, copy_file, makedirs, unicode_str,
 )
 
 
@@ -54,8 +60,14 @@ class Mustache(Task):
             "filters": self.site.config['FILTERS'],
             "blog_title": self.site.config['BLOG_TITLE'],
             "content_footer": self.site.config['CONTENT_FOOTER'],
+            "shared_globals": self.site.config.get('MUSTACHE_SHARED_GLOBALS',
+                                                   False),
         }
 
+        # The JSON files are loaded from the site, which may not be at
+        # the root of its domain.
+        base_path = urlsplit(self.site.config['BASE_URL']).path.rstrip('/')
+
         # TODO: timeline is global, get rid of it
         posts = [x for x in self.site.timeline if x.use_in_feeds]
         if not posts:
@@ -65,17 +77,19 @@ class Mustache(Task):
             }
             return
 
-        def write_file(path, post, lang):
+        def json_link(post, lang):
+            if not post:
+                return False
+            return post.permalink(lang).replace(".html", ".json")
 
-            # Prev/Next links
-            prev_link = False
-            if post.prev_post:
-                prev_link = post.prev_post.permalink(lang).replace(".html",
-                                                                   ".json")
-            next_link = False
-            if post.next_post:
-                next_link = post.next_post.permalink(lang).replace(".html",
-                                                                   ".json")
+        def globals_name(lang):
+            return 'globals-{0}.json'.format(lang)
+
+        def globals_url(lang):
+            return base_path + "/" + globals_name(lang)
+
+        def get_globals(lang):
+            """Return the data shared by every post in a language."""
             data = {}
 
             # Configuration
@@ -83,6 +97,35 @@ class Mustache(Task):
                 if isinstance(v, (str, unicode_str)):  # NOQA
                     data[k] = v
 
+            # Template strings
+            for k, v in kw["messages"][lang].items():
+                data["message_" + k] = v
+
+            return data
+
+        # The comment form only has mustache placeholders in it, so it
+        # is the same for every post in a language.
+        comment_forms = {}
+
+        def get_comment_html(lang):
+            if lang not in comment_forms:
+                context = dict(lang=lang)
+                context.update(self.site.GLOBAL_CONTEXT)
+                comment_forms[lang] = self.site.template_system.render_template(
+                    'mustache-comment-form.tmpl', None, context).strip()
+            return comment_forms[lang]
+
+        def write_file(path, post, lang):
+
+            # Prev/Next links
+            prev_link = json_link(post.prev_post, lang)
+            next_link = json_link(post.next_post, lang)
+            if kw["shared_globals"]:
+                data = {"globals": globals_url(lang)}
+            else:
+                data = get_globals(lang)
+                data["comment_html"] = get_comment_html(lang)
+
             # Tag data
             tags = []
             for tag in post.tags:
@@ -93,10 +136,6 @@ class Mustache(Task):
                 "tags?": True if tags else False,
             })
 
-            # Template strings
-            for k, v in kw["messages"][lang].items():
-                data["message_" + k] = v
-
             # Post data
             data.update({
                 "title": post.title(lang),
@@ -107,12 +146,6 @@ class Mustache(Task):
                 post.date.strftime(self.site.GLOBAL_CONTEXT['date_format']),
             })
 
-            # Comments
-            context = dict(post=post, lang=LocaleBorg().current_lang)
-            context.update(self.site.GLOBAL_CONTEXT)
-            data["comment_html"] = self.site.template_system.render_template(
-                'mustache-comment-form.tmpl', None, context).strip()
-
             # Post translations
             translations = []
             for langname in kw["translations"]:
@@ -120,7 +153,7 @@ class Mustache(Task):
                     continue
                 translations.append({'name':
                                      kw["messages"][langname]["Read in English"],
-                                    'link': "javascript:load_data('%s');" % post.permalink(langname).replace(".html", ".json")
+                                    'link': "javascript:load_data('%s');" % json_link(post, langname)
                                      })
             data["translations"] = translations
 
@@ -128,7 +161,65 @@ class Mustache(Task):
             with codecs.open(path, 'wb+', 'utf8') as fd:
                 fd.write(json.dumps(data))
 
+        def write_globals(path, lang):
+            data = get_globals(lang)
+            data["comment_html"] = get_comment_html(lang)
+            makedirs(os.path.dirname(path))
+            with codecs.open(path, 'wb+', 'utf8') as fd:
+                fd.write(json.dumps(data))
+
+        def index_name(lang, page):
+            return 'mustache-index-{0}-{1}.json'.format(lang, page)
+
+        def index_url(lang, page):
+            return base_path + "/" + index_name(lang, page)
+
+        def remove_stale_indexes(lang, page_count):
+            """Remove the index pages left over from a longer index."""
+            if not os.path.isdir(kw['output_folder']):
+                return
+            prefix, suffix = index_name(lang, '*').split('*')
+            for name in os.listdir(kw['output_folder']):
+                if not (name.startswith(prefix) and name.endswith(suffix)):
+                    continue
+                page = name[len(prefix):-len(suffix)]
+                if page.isdigit() and int(page) >= page_count:
+                    os.unlink(os.path.join(kw['output_folder'], name))
+
+        def post_summary(post, lang):
+            return {
+                "title": post.title(lang),
+                "date":
+                post.date.strftime(self.site.GLOBAL_CONTEXT['date_format']),
+                "link": json_link(post, lang),
+                "permalink": post.permalink(lang),
+                "tags": post.tags,
+            }
+
+        def write_index(path, data):
+            makedirs(os.path.dirname(path))
+            with codecs.open(path, 'wb+', 'utf8') as fd:
+                fd.write(json.dumps(data))
+
         for lang in kw["translations"]:
+            if kw["shared_globals"]:
+                out_file = os.path.join(kw['output_folder'],
+                                        globals_name(lang))
+                yield {
+                    'basename': 'render_mustache',
+                    'name': out_file,
+                    'file_dep': self.site.template_system.template_deps(
+                        'mustache-comment-form.tmpl'),
+                    'targets': [out_file],
+                    'actions': [(write_globals, (out_file, lang))],
+                    'uptodate': [config_changed(get_globals(lang))],
+                }
+
+            if not kw["shared_globals"]:
+                globals_digest = hashlib.md5(json.dumps(
+                    get_globals(lang), sort_keys=True).encode('utf-8')
+                ).hexdigest()
+
             for i, post in enumerate(posts):
                 out_path = post.destination_path(lang, ".json")
                 out_file = os.path.join(kw['output_folder'], out_path)
@@ -139,18 +230,63 @@ class Mustache(Task):
                     'targets': [out_file],
                     'actions': [(write_file, (out_file, post, lang))],
                     'task_dep': ['render_posts'],
+                    # The fragment file_dep already covers the post's
+                    # text, so nothing has to be rendered to check this.
                     'uptodate': [config_changed({
-                        1: post.text(lang),
-                        2: post.prev_post,
-                        3: post.next_post,
-                        4: post.title(lang),
+                        1: json_link(post.prev_post, lang),
+                        2: json_link(post.next_post, lang),
+                        3: post.title(lang),
+                        4: globals_url(lang) if kw["shared_globals"]
+                        else globals_digest,
+                        5: post.tags,
+                        6: post.date.strftime(
+                            self.site.GLOBAL_CONTEXT['date_format']),
+                        7: [json_link(post, langname)
+                            for langname in kw["translations"]],
                     })]
                 }
                 yield task
 
+            # Paginated index.  Pages are filled from the oldest post on,
+            # so a new post only changes the newest page, and pages are
+            # written again only when their own data changes.
+            chronological = posts[::-1]
+            page_size = kw["index_display_post_count"]
+            pages = [chronological[i:i + page_size]
+                     for i in range(0, len(chronological), page_size)]
+            for i, page in enumerate(pages):
+                out_file = os.path.join(kw['output_folder'],
+                                        index_name(lang, i))
+                data = {
+                    "posts": [post_summary(post, lang)
+                              for post in reversed(page)],
+                    "page": i,
+                    "older": index_url(lang, i - 1) if i else False,
+                    "newer": (index_url(lang, i + 1)
+                              if i + 1 < len(pages) else False),
+                }
+                yield {
+                    'basename': 'render_mustache',
+                    'name': out_file,
+                    'targets': [out_file],
+                    'actions': [(write_index, (out_file, data))],
+                    'uptodate': [config_changed(data)],
+                }
+
+            # Pages past the end are not targets of any task anymore,
+            # so they have to be removed by hand.
+            yield {
+                'basename': 'render_mustache',
+                'name': 'stale-indexes-{0}'.format(lang),
+                'actions': [(remove_stale_indexes, (lang, len(pages)))],
+                'uptodate': [config_changed({1: len(pages)})],
+            }
+
         if posts:
             first_post_data = posts[0].permalink(
                 self.site.config["DEFAULT_LANG"]).replace(".html", ".json")
+            first_index_data = index_url(
+                self.site.config["DEFAULT_LANG"], len(pages) - 1)
 
         # Copy mustache template
         src = os.path.join(os.path.dirname(__file__), 'mustache-template.html')
@@ -170,14 +306,16 @@ class Mustache(Task):
         def copy_mustache():
             with codecs.open(src, 'rb', 'utf8') as in_file:
                 with codecs.open(dst, 'wb+', 'utf8') as out_file:
-                    data = in_file.read().replace('{{first_post_data}}',
-                                                  first_post_data)
+                    data = in_file.read().replace(
+                        '{{first_post_data}}', first_post_data).replace(
+                        '{{first_index_data}}', first_index_data)
                     out_file.write(data)
         yield {
             'basename': 'render_mustache',
             'name': dst,
             'targets': [dst],
             'file_dep': [src],
-            'uptodate': [config_changed({1: first_post_data})],
+            'uptodate': [config_changed({1: first_post_data,
+                                         2: first_index_data})],
             'actions': [(copy_mustache, [])],
         }
@@ -25,12 +25,33 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 from __future__ import print_function, unicode_literals
+import calendar
 import codecs
 import datetime
+from email.utils import formatdate
 import hashlib
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 import os
+import socket
 import sys
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape, quoteattr
+import zlib
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET  # NOQA
+
+try:
+    import httplib
+    from urlparse import urljoin, urlsplit
+except ImportError:
+    import http.client as httplib  # NOQA
+    from urllib.parse import urljoin, urlsplit  # NOQA
 
 from doit.tools import timeout
 from nikola.plugin_categories import Command, Task
@@ -63,17 +84,358 @@ if peewee is not None:
         content = peewee.TextField()
         link = peewee.CharField(max_length=200)
         title = peewee.CharField(max_length=200)
-        guid = peewee.CharField(max_length=200)
+        guid = peewee.CharField(max_length=200, unique=True)
+        # A hash of what goes in the generated post, see entry_fingerprint
+        fingerprint = peewee.CharField(max_length=32, null=True)
+
+        class Meta:
+            indexes = (
+                (('feed', 'date'), False),
+            )
+
+
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+# Atom 1.0, Atom 0.3, RSS 0.9x/2.0, RSS 1.0 and RSS 0.90 entries
+ENTRY_TAGS = set([
+    '{http://www.w3.org/2005/Atom}entry',
+    '{http://purl.org/atom/ns#}entry',
+    'item',
+    '{http://purl.org/rss/1.0/}item',
+    '{http://my.netscape.com/rdf/simple/0.9/}item',
+])
+
+
+def iter_feed(source, response_headers=None):
+    """Parse a RSS/Atom feed, one entry at a time.
+
+    source is a file name or a file object.  Returns a feedparser result
+    whose entries are a generator, so that only one entry is kept in
+    memory, whatever the size of the feed.  The feed data is parsed by
+    feedparser from the elements before the first entry, and each entry
+    is parsed by feedparser on its own, wrapped in (empty) copies of the
+    elements that contain it.  The namespace prefixes of the document
+    are kept, as feedparser depends on some of them.
+
+    Raises a SyntaxError if the feed data is not well formed XML.  If an
+    entry is not, the whole feed is parsed again by feedparser, which is
+    more lenient (e.g. with undefined entities like &nbsp;), and the
+    entries after the ones already returned come from it.
+    response_headers are only used in that case.
+    """
+    events = ET.iterparse(source, events=('start', 'end', 'start-ns'))
+    prefixes = {XML_NS: 'xml'}
+    stack = []
+    for event, elem in events:
+        if event == 'start-ns':
+            _add_prefix(prefixes, *elem)
+        elif event == 'start':
+            stack.append(elem)
+            if elem.tag in ENTRY_TAGS:
+                break
+        else:
+            root = stack.pop()
+    if stack:
+        root = stack[0]
+    channel = feedparser.parse(_tostring(_copy_without_entries(root), prefixes))
+
+    def entries():
+        if not stack:
+            return
+        parsed = 0
+        try:
+            for event, elem in events:
+                if event == 'start-ns':
+                    _add_prefix(prefixes, *elem)
+                elif event == 'start':
+                    stack.append(elem)
+                else:
+                    stack.pop()
+                    if elem.tag in ENTRY_TAGS:
+                        parsed += 1
+                        entry = _parse_entry(stack, elem, prefixes)
+                        if entry is not None:
+                            yield entry
+                        # Forget the entry, it was already parsed
+                        if stack:
+                            stack[-1].remove(elem)
+                        elem.clear()
+        except SyntaxError as e:
+            LOGGER.warn("Malformed entry ({0}), parsing the whole feed "
+                        "again.".format(e))
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            fallback = feedparser.parse(source, response_headers=response_headers)
+            for entry in fallback.entries[parsed:]:
+                yield entry
+
+    channel['entries'] = entries()
+    return channel
+
+
+def _add_prefix(prefixes, prefix, uri):
+    if uri not in prefixes:
+        if prefix in prefixes.values():
+            prefix = 'ns%d' % len(prefixes)
+        prefixes[uri] = prefix
+
+
+def _copy_without_entries(elem):
+    copy = ET.Element(elem.tag, elem.attrib)
+    copy.text = elem.text
+    copy.tail = elem.tail
+    for child in elem:
+        if child.tag not in ENTRY_TAGS:
+            copy.append(_copy_without_entries(child))
+    return copy
+
+
+def _parse_entry(ancestors, entry, prefixes):
+    root = parent = ET.Element(ancestors[0].tag, ancestors[0].attrib)
+    for ancestor in ancestors[1:]:
+        parent = ET.SubElement(parent, ancestor.tag, ancestor.attrib)
+    parent.append(entry)
+    parsed = feedparser.parse(_tostring(root, prefixes))
+    return parsed.entries[0] if parsed.entries else None
+
+
+def _qname(name, prefixes):
+    if name[0] == '{':
+        uri, name = name[1:].split('}', 1)
+        if prefixes[uri]:
+            name = prefixes[uri] + ':' + name
+    return name
+
+
+def _serialize(elem, prefixes, out, declarations=''):
+    tag = _qname(elem.tag, prefixes)
+    out.append('<' + tag + declarations)
+    for key, value in elem.attrib.items():
+        out.append(' %s=%s' % (_qname(key, prefixes), quoteattr(value)))
+    out.append('>')
+    if elem.text:
+        out.append(escape(elem.text))
+    for child in elem:
+        _serialize(child, prefixes, out)
+    out.append('</%s>' % tag)
+    if elem.tail:
+        out.append(escape(elem.tail))
+
+
+def _tostring(root, prefixes):
+    """Serialize root, declaring all the namespaces with their prefixes."""
+    declarations = ''.join(
+        ' xmlns%s=%s' % (':' + prefix if prefix else '', quoteattr(uri))
+        for uri, prefix in prefixes.items() if uri != XML_NS)
+    out = []
+    _serialize(root, prefixes, out, declarations)
+    return ''.join(out).encode('utf-8')
+
+
+def entry_fingerprint(title, link, date, content):
+    """Return a hash of the data of an entry that ends up in its post."""
+    h = hashlib.md5()
+    for value in (title, link, date.isoformat(), content):
+        h.update(value.encode('utf8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class FeedFetcher(object):
+    """Fetch many feeds at once, using a pool of threads.
+
+    Connections are reused for feeds on the same host, requests time out
+    after `timeout` seconds, and failed requests are retried `retries`
+    times, waiting `backoff` seconds (doubled on each retry) in between.
+    Like feedparser, conditional requests are made using the feed's etag
+    and last modification date.
+    """
+
+    MAX_REDIRECTS = 5
+    CHUNK_SIZE = 64 * 1024
+    # Bigger bodies are written to a temporary file
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, workers=8, timeout=30, retries=2, backoff=1):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def fetch_all(self, feeds):
+        """Fetch feeds, yielding (feed, parsed) pairs as they are done.
+
+        Each feed is a Feed, or any object with url, etag and
+        last_modified attributes.  parsed is what feedparser.parse
+        returns, or None if the feed could not be fetched.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self._fetch_one, feeds):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+            self.close()
+
+    def fetch(self, url, etag=None, modified=None):
+        """Fetch and parse one feed, following redirects."""
+        headers = {
+            'User-Agent': feedparser.USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = formatdate(
+                calendar.timegm(modified.timetuple()), usegmt=True)
+
+        href = url
+        for _ in range(self.MAX_REDIRECTS + 1):
+            status, response_headers, body_file = self._request(href, headers)
+            if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                href = urljoin(href, response_headers['location'])
+                continue
+            break
+
+        if status == 304:
+            parsed = feedparser.FeedParserDict(feed=feedparser.FeedParserDict(), entries=[])
+        else:
+            # Entries are parsed one at a time, as they are stored, so
+            # big feeds don't have to fit in memory.
+            try:
+                parsed = iter_feed(body_file, response_headers)
+            except SyntaxError:
+                body_file.seek(0)
+                parsed = feedparser.parse(body_file, response_headers=response_headers)
+        parsed['status'] = status
+        parsed['href'] = href
+        if 'etag' in response_headers:
+            parsed['etag'] = response_headers['etag']
+        return parsed
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            for connections in self._connections.values():
+                for connection in connections:
+                    connection.close()
+            self._connections = {}
+
+    def _fetch_one(self, feed):
+        try:
+            return feed, self.fetch(feed.url, feed.etag, feed.last_modified)
+        except Exception as e:
+            LOGGER.warn("Failed to fetch {0}: {1}".format(feed.url, e))
+            return feed, None
+
+    def _request(self, url, headers):
+        """Make a GET request, retrying on errors.
+
+        Returns (status, headers, body_file), where body_file has the
+        decompressed body, and is only kept in memory if it is small.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        attempt = 0
+        while True:
+            connection, reused = self._get_connection(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body_file = self._read_body(response)
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if reused:
+                    # The server probably closed the idle connection
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                response_headers = dict((k.lower(), v) for k, v in response.getheaders())
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._put_connection(key, connection)
+                if response.status < 500 or attempt >= self.retries:
+                    return response.status, response_headers, body_file
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _read_body(self, response):
+        encoding = response.getheader('content-encoding', '')
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = None
+        body_file = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+        while True:
+            chunk = response.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            body_file.write(chunk)
+        if decompressor is not None:
+            body_file.write(decompressor.flush())
+        body_file.seek(0)
+        return body_file
+
+    def _get_connection(self, key):
+        with self._lock:
+            connections = self._connections.get(key)
+            if connections:
+                return connections.pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _put_connection(self, key, connection):
+        with self._lock:
+            self._connections.setdefault(key, []).append(connection)
 
 
 class Planetoid(Command, Task):
     """Maintain a planet-like thing."""
     name = "planetoid"
 
+    # Used by other plugins, like import_feed
+    iter_feed = staticmethod(iter_feed)
+
+    # Rows per INSERT, to stay below SQLite's limit of 999 variables
+    INSERT_BATCH_SIZE = 100
+
     def init_db(self):
         # setup database
         Feed.create_table(fail_silently=True)
         Entry.create_table(fail_silently=True)
+        self.migrate_db()
+
+    def migrate_db(self):
+        "Add what is missing from databases created by older versions."
+        db = Entry._meta.database
+        try:
+            db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS entry_guid ON entry (guid)')
+        except Exception as e:
+            LOGGER.warn("Can't add a unique index on entry guids, are there duplicates? {0}".format(e))
+        db.execute_sql('CREATE INDEX IF NOT EXISTS entry_feed_id_date ON entry (feed_id, date)')
+        columns = [row[1] for row in db.execute_sql('PRAGMA table_info(entry)').fetchall()]
+        if 'fingerprint' not in columns:
+            db.execute_sql('ALTER TABLE entry ADD COLUMN fingerprint VARCHAR(32)')
+        # Fill in the fingerprints of entries fetched by older versions
+        with db.transaction():
+            for entry in Entry.select().where(Entry.fingerprint >> None):
+                entry.fingerprint = entry_fingerprint(entry.title, entry.link, entry.date, entry.content)
+                entry.save()
 
     def gen_tasks(self):
         if peewee is None or sys.version_info[0] == 3:
@@ -139,28 +501,21 @@ class Planetoid(Command, Task):
             feed.url = url
             feed.save()
 
-        for feed, name in feeds:
-            f = Feed.select().where(Feed.name == name)
-            if not list(f):
-                add_feed(name, feed)
-            elif list(f)[0].url != feed:
-                update_feed_url(list(f)[0], feed)
+        known_feeds = dict((f.name, f) for f in Feed.select())
+        with Feed._meta.database.transaction():
+            for feed, name in feeds:
+                f = known_feeds.get(name)
+                if f is None:
+                    add_feed(name, feed)
+                elif f.url != feed:
+                    update_feed_url(f, feed)
 
     def task_update_feeds(self):
         """Download feed contents, add entries to the database."""
-        def update_feed(feed):
-            modified = feed.last_modified.timetuple()
-            etag = feed.etag
-            try:
-                parsed = feedparser.parse(
-                    feed.url,
-                    etag=etag,
-                    modified=modified
-                )
-                feed.last_status = str(parsed.status)
-            except:  # Probably a timeout
-                # TODO: log failure
+        def update_feed(feed, parsed):
+            if parsed is None:  # Probably a timeout
                 return
+            feed.last_status = str(parsed.status)
             if parsed.feed.get('title'):
                 LOGGER.info(parsed.feed.title)
             else:
@@ -175,6 +530,7 @@ class Planetoid(Command, Task):
             if parsed.status > 400:
                 # TODO log failure
                 return
+            entries = {}
             for entry_data in parsed.entries:
                 LOGGER.info("=========================================")
                 date = entry_data.get('published_parsed', None)
@@ -182,7 +538,7 @@ class Planetoid(Command, Task):
                     date = entry_data.get('updated_parsed', None)
                 if date is None:
                     LOGGER.error("Can't parse date from:\n", entry_data)
-                    return False
+                    break
                 LOGGER.info("DATE:===>", date)
                 date = datetime.datetime(*(date[:6]))
                 title = "%s: %s" % (feed.name, entry_data.get('title', 'Sin título'))
@@ -196,49 +552,63 @@ class Planetoid(Command, Task):
                 guid = str(entry_data.get('guid', entry_data.link))
                 link = entry_data.link
                 LOGGER.info(repr([date, title]))
-                e = list(Entry.select().where(Entry.guid == guid))
-                LOGGER.info(
-                    repr(dict(
-                        date=date,
-                        title=title,
-                        content=content,
-                        guid=guid,
-                        feed=feed,
-                        link=link,
-                    ))
+                entries[guid] = dict(
+                    date=date,
+                    title=title,
+                    content=content,
+                    guid=guid,
+                    feed=feed,
+                    link=link,
+                    fingerprint=entry_fingerprint(title, link, date, content),
                 )
-                if not e:
-                    entry = Entry.create(
-                        date=date,
-                        title=title,
-                        content=content,
-                        guid=guid,
-                        feed=feed,
-                        link=link,
-                    )
-                else:
-                    entry = e[0]
-                    entry.date = date
-                    entry.title = title
-                    entry.content = content
-                    entry.link = link
-                entry.save()
-        flag = False
-        for feed in Feed.select():
-            flag = True
-            task = {
-                'basename': self.name + "_fetch_feed",
-                'name': str(feed.url),
-                'actions': [(update_feed, (feed, ))],
-                'uptodate': [timeout(datetime.timedelta(minutes=self.site.config.get('PLANETOID_REFRESH', 60)))],
-            }
-            yield task
-        if not flag:
-            yield {
-                'basename': self.name + "_fetch_feed",
-                'name': '',
-                'actions': [],
-            }
+                LOGGER.info(repr(entries[guid]))
+                if len(entries) >= self.INSERT_BATCH_SIZE:
+                    store_entries(entries)
+                    entries = {}
+            store_entries(entries)
+
+        def store_entries(entries):
+            """Insert or update entries (a dict of guid: data) in one transaction."""
+            if not entries:
+                return
+            with Entry._meta.database.transaction():
+                guids = list(entries)
+                for i in range(0, len(guids), self.INSERT_BATCH_SIZE):
+                    batch = guids[i:i + self.INSERT_BATCH_SIZE]
+                    for entry in Entry.select().where(Entry.guid << batch):
+                        data = entries.pop(entry.guid)
+                        if entry.fingerprint != data['fingerprint']:
+                            entry.date = data['date']
+                            entry.title = data['title']
+                            entry.content = data['content']
+                            entry.link = data['link']
+                            entry.fingerprint = data['fingerprint']
+                            entry.save()
+                new_entries = list(entries.values())
+                for i in range(0, len(new_entries), self.INSERT_BATCH_SIZE):
+                    Entry.insert_many(new_entries[i:i + self.INSERT_BATCH_SIZE]).execute()
+
+        def update_feeds(feeds):
+            fetcher = FeedFetcher(
+                workers=self.site.config.get('PLANETOID_WORKERS', 8),
+                timeout=self.site.config.get('PLANETOID_TIMEOUT', 30),
+                retries=self.site.config.get('PLANETOID_RETRIES', 2),
+            )
+            # Feeds are fetched in parallel, but the database is only
+            # updated from this thread.
+            for feed, parsed in fetcher.fetch_all(feeds):
+                update_feed(feed, parsed)
+
+        feeds = list(Feed.select())
+        yield {
+            'basename': self.name + "_fetch_feed",
+            'name': '',
+            'actions': [(update_feeds, (feeds, ))] if feeds else [],
+            'uptodate': [
+                timeout(datetime.timedelta(minutes=self.site.config.get('PLANETOID_REFRESH', 60))),
+                config_changed({1: [feed.url for feed in feeds]}),
+            ],
+        }
 
     def task_generate_posts(self):
         """Generate post files for the blog entries."""
@@ -248,7 +618,8 @@ class Planetoid(Command, Task):
             h.update(entry.guid)
             return h.hexdigest()
 
-        def generate_post(entry):
+        def generate_post(entry_id):
+            entry = Entry.get(Entry.id == entry_id)
             unique_id = gen_id(entry)
             meta_path = os.path.join('posts', unique_id + '.meta')
             post_path = os.path.join('posts', unique_id + '.txt')
@@ -269,15 +640,26 @@ class Planetoid(Command, Task):
         if not os.path.isdir('posts'):
             os.mkdir('posts')
         flag = False
-        for entry in Entry.select().order_by(Entry.date.desc()):
+        # The content of the entries is only loaded for posts that need
+        # to be generated again, as told by their fingerprints.
+        entries = Entry.select(
+            Entry.id, Entry.guid, Entry.date, Entry.fingerprint, Entry.feed, Feed.name
+        ).join(Feed).order_by(Entry.date.desc())
+        max_age = self.site.config.get('PLANETOID_MAX_AGE', None)
+        if max_age is not None:
+            entries = entries.where(Entry.date >= datetime.datetime.now() - datetime.timedelta(days=max_age))
+        max_entries = self.site.config.get('PLANETOID_MAX_ENTRIES', None)
+        if max_entries is not None:
+            entries = entries.limit(max_entries)
+        for entry in entries:
             flag = True
             entry_id = gen_id(entry)
             yield {
                 'basename': self.name + "_generate_posts",
                 'targets': [os.path.join('posts', entry_id + '.meta'), os.path.join('posts', entry_id + '.txt')],
                 'name': entry_id,
-                'actions': [(generate_post, (entry,))],
-                'uptodate': [config_changed({1: entry})],
+                'actions': [(generate_post, (entry.id,))],
+                'uptodate': [config_changed({1: entry.fingerprint})],
                 'task_dep': [self.name + "_fetch_feed"],
             }
         if not flag:
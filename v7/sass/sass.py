@@ -24,17 +24,161 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from __future__ import unicode_literals
+from __future__ import absolute_import, unicode_literals
 
 import codecs
 import glob
+import hashlib
+import json
 import os
+import re
 import sys
 import subprocess
 
 from nikola.plugin_categories import Task
 from nikola import utils
 
+try:
+    import sass as libsass
+except ImportError:
+    libsass = None  # NOQA
+
+
+# @import, @use and @forward rules, up to the end of the statement.
+IMPORT_RE = re.compile(r'@(import|use|forward)\s+([^;\n]+)')
+QUOTED_RE = re.compile(r'[\'"]([^\'"]+)[\'"]')
+
+
+def parse_imports(path):
+    """Return the names imported by a Sass file, as written in it."""
+    with codecs.open(path, "rb", "utf-8") as inf:
+        data = inf.read()
+    names = []
+    for rule, args in IMPORT_RE.findall(data):
+        if rule == 'import':
+            # @import "a", "b" in .scss, or @import a, b in .sass, maybe
+            # followed by media queries
+            candidates = []
+            for arg in args.split(','):
+                quoted = QUOTED_RE.match(arg.strip())
+                if quoted:
+                    candidates.append(quoted.group(1))
+                elif arg.split():
+                    candidates.append(arg.split()[0])
+        else:
+            candidates = QUOTED_RE.findall(args)[:1]
+        for name in candidates:
+            # Plain CSS imports are left alone by Sass, and built-in
+            # modules (like sass:math) are not files
+            if (not name or name.startswith(('url(', 'http://', 'https://', '//', 'sass:')) or
+                    name.endswith('.css')):
+                continue
+            names.append(name)
+    return names
+
+
+def libsass_options(options):
+    """Return the libsass arguments matching SASS_OPTIONS, or None if some
+    of them have no libsass equivalent."""
+    kwargs = {'include_paths': []}
+    options = list(options)
+    while options:
+        option = options.pop(0)
+        if '=' in option:
+            option, value = option.split('=', 1)
+        elif option in ('-t', '--style', '-I', '--load-path', '--precision'):
+            if not options:
+                return None
+            value = options.pop(0)
+        else:
+            value = None
+        if option in ('-t', '--style') and value:
+            kwargs['output_style'] = value
+        elif option in ('-I', '--load-path') and value:
+            kwargs['include_paths'].append(value)
+        elif option == '--precision' and value and value.isdigit():
+            kwargs['precision'] = int(value)
+        elif option in ('--no-source-map', '--sourcemap') and value in (None, 'none'):
+            continue
+        else:
+            return None
+    return kwargs
+
+
+class ImportGraph(object):
+    """The imports between Sass files, with the imports of each file
+    cached by its modification time."""
+
+    CACHE_VERSION = 2
+
+    def __init__(self, sources, cache_path, extensions):
+        # sources maps paths relative to the sources folder to real paths
+        self.sources = sources
+        self.cache_path = cache_path
+        self.extensions = extensions
+        self._changed = False
+        self._cache = {}
+        try:
+            with codecs.open(cache_path, "rb", "utf-8") as inf:
+                cache = json.load(inf)
+            if cache.get('version') == self.CACHE_VERSION:
+                self._cache = cache['files']
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        if not self._changed:
+            return
+        utils.makedirs(os.path.dirname(self.cache_path))
+        with codecs.open(self.cache_path, "wb+", "utf-8") as outf:
+            outf.write(json.dumps({'version': self.CACHE_VERSION,
+                                   'files': self._cache}))
+        self._changed = False
+
+    def names(self, name):
+        """Return the names imported by a source file."""
+        path = self.sources[name]
+        mtime = os.stat(path).st_mtime
+        cached = self._cache.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self._cache[path] = [mtime, parse_imports(path)]
+            self._changed = True
+        return cached[1]
+
+    def resolve(self, name, imported):
+        """Return the source file an import refers to, or None."""
+        for folder in (os.path.dirname(name), ''):
+            for candidate in self._candidates(imported):
+                candidate = os.path.normpath(os.path.join(folder, candidate))
+                if candidate in self.sources:
+                    return candidate
+        return None
+
+    def _candidates(self, imported):
+        folder, base = os.path.split(imported.replace('/', os.sep))
+        if os.path.splitext(base)[1] in self.extensions:
+            names = [base, '_' + base]
+        else:
+            names = []
+            for ext in self.extensions:
+                names += [base + ext, '_' + base + ext,
+                          os.path.join(base, '_index' + ext),
+                          os.path.join(base, 'index' + ext)]
+        return [os.path.join(folder, x) for x in names]
+
+    def dependencies(self, name):
+        """Return all the source files a file imports, directly or not."""
+        seen = set()
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            for imported in self.names(current):
+                dep = self.resolve(current, imported)
+                if dep is not None and dep not in seen and dep != name:
+                    seen.add(dep)
+                    pending.append(dep)
+        return sorted(seen)
+
 
 class BuildSass(Task):
     """Generate CSS out of Sass sources."""
@@ -85,30 +229,93 @@ class BuildSass(Task):
                 yield task
 
         # Build targets and write CSS files
-        base_path = utils.get_theme_path(self.site.THEMES[0])
         dst_dir = os.path.join(self.site.config['OUTPUT_FOLDER'], 'assets', 'css')
-        # Make everything depend on all sources, rough but enough
-        deps = []
-        for ext in self.sources_ext:
-            if os.path.isfile(os.path.join(self.sources_folder, "targets")):
-                deps += glob.glob(os.path.join(kw['cache_folder'], self.sources_folder,
-                                               '*{0}'.format(ext)))
+        # Each target depends on the sources it imports, directly or not
+        sources = {}
+        for folder in [self.sources_folder] + [
+                os.path.join(utils.get_theme_path(theme_name), self.sources_folder)
+                for theme_name in kw['themes']]:
+            for root, dirs, files in os.walk(folder):
+                for fname in files:
+                    if os.path.splitext(fname)[1] not in self.sources_ext:
+                        continue
+                    path = os.path.join(root, fname)
+                    sources.setdefault(os.path.relpath(path, folder), path)
+        graph = ImportGraph(sources,
+                            os.path.join(kw['cache_folder'], self.name, 'imports.json'),
+                            self.sources_ext)
+
+        def get_deps(target):
+            if target in sources:
+                names = [target] + graph.dependencies(target)
             else:
-                deps += glob.glob(os.path.join(base_path, self.sources_folder,
-                                               '*{0}'.format(ext)))
+                names = sorted(sources)
+            return [os.path.join(kw['cache_folder'], self.sources_folder, x)
+                    for x in names]
+
+        # Compile in-process with libsass if it's installed and understands
+        # all the SASS_OPTIONS, saving the startup of a compiler per target.
+        libsass_kwargs = None
+        if libsass is not None and self.site.config.get('SASS_IN_PROCESS', True):
+            libsass_kwargs = libsass_options(self.compiler_options)
+        if libsass_kwargs is not None:
+            backend = 'libsass {0}'.format(libsass.__version__)
+        else:
+            backend = self.compiler_name
+        kw['backend'] = backend
+        kw['options'] = self.compiler_options
+        output_cache = os.path.join(kw['cache_folder'], self.name, 'css')
 
-        def compile_target(target, dst):
+        def output_cache_path(target, deps):
+            """Return the path of the cached CSS for a target, keyed by the
+            contents of its sources, the compiler and its options."""
+            h = hashlib.sha1()
+            h.update(json.dumps([backend, self.compiler_options]).encode('utf-8'))
+            for dep in deps:
+                h.update(dep.encode('utf-8'))
+                with open(dep, 'rb') as inf:
+                    h.update(hashlib.sha1(inf.read()).digest())
+            return os.path.join(output_cache, os.path.splitext(target)[0],
+                                h.hexdigest() + '.css')
+
+        def compile_target(target, dst, deps):
             utils.makedirs(dst_dir)
             run_in_shell = sys.platform == 'win32'
             src = os.path.join(kw['cache_folder'], self.sources_folder, target)
-            try:
-                compiled = subprocess.check_output([self.compiler_name] + self.compiler_options + [src], shell=run_in_shell)
-            except OSError:
-                utils.req_missing([self.compiler_name],
-                                  'build Sass files (and use this theme)',
-                                  False, False)
+            cache_path = output_cache_path(target, deps)
+            if os.path.isfile(cache_path):
+                utils.copy_file(cache_path, dst)
+                return
+            compiled = None
+            if libsass_kwargs is not None:
+                kwargs = dict(libsass_kwargs)
+                kwargs['include_paths'] = [os.path.dirname(src)] + kwargs['include_paths']
+                try:
+                    compiled = libsass.compile(filename=src, **kwargs)
+                except libsass.CompileError as e:
+                    # libsass doesn't support newer Sass, like @use and
+                    # @forward, which SASS_COMPILER may understand
+                    self.logger.warn('libsass could not compile {0}, using {1}: {2}'.format(
+                        target, self.compiler_name, e))
+                else:
+                    if not isinstance(compiled, bytes):
+                        compiled = compiled.encode('utf-8')
+            if compiled is None:
+                try:
+                    compiled = subprocess.check_output([self.compiler_name] + self.compiler_options + [src], shell=run_in_shell)
+                except OSError:
+                    utils.req_missing([self.compiler_name],
+                                      'build Sass files (and use this theme)',
+                                      False, False)
+                    return False
             with open(dst, "wb+") as outf:
                 outf.write(compiled)
+            # Keep only the latest CSS of each target in the cache
+            utils.makedirs(os.path.dirname(cache_path))
+            for old in glob.glob(os.path.join(os.path.dirname(cache_path), '*.css')):
+                os.remove(old)
+            with open(cache_path, "wb+") as outf:
+                outf.write(compiled)
 
         yield self.group_task()
 
@@ -131,13 +338,16 @@ class BuildSass(Task):
             else:
                 seennames.update({base: target})
 
+            deps = get_deps(target)
             yield {
                 'basename': self.name,
                 'name': dst,
                 'targets': [dst],
                 'file_dep': deps,
                 'task_dep': ['prepare_sass_sources'],
-                'actions': ((compile_target, [target, dst]), ),
+                'actions': ((compile_target, [target, dst, deps]), ),
                 'uptodate': [utils.config_changed(kw)],
                 'clean': True
             }
+
+        graph.save()
@@ -7,30 +7,135 @@
 
 
 from __future__ import unicode_literals
+import hashlib
 import io
 import os
+from multiprocessing.pool import ThreadPool
 from nikola.plugin_categories import Task
-from nikola.utils import config_changed, LocaleBorg, makedirs, copy_file
+from nikola.utils import (config_changed, LocaleBorg, makedirs, copy_file,
+                          req_missing)
 import lxml
 import nssjson as json
 
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit  # NOQA
+
+try:
+    from PIL import Image  # NOQA
+except ImportError:
+    try:
+        import Image  # NOQA
+    except ImportError:
+        Image = None  # NOQA
+
 def _id(post, lang):
     return post.permalink(lang) + '.json'
 
-_image_size_cache = {}
 
-def _calc_photo_data(img_list, img_titles, thumbs, output_name):
+def _delta_path(path):
+    return path[:-len('.json')] + '.delta.json'
+
+
+def _fragment_id(permalink):
+    return hashlib.md5(permalink.encode('utf-8')).hexdigest()
+
+
+def _fragment_version(post_dict):
+    """Return a hash of the contents of a fragment, so that its URL
+    changes with them and clients can cache it for good."""
+    data = json.dumps(post_dict, iso_datetime=True, sort_keys=True)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def _read_image_size(path):
+    """Return the width and height of an image.  PIL only reads the
+    header of the file to get them."""
+    with open(path, 'rb') as f:
+        return Image.open(f).size
+
+
+class _ImageSizes(object):
+    """Image sizes, cached in a file by path, modification time and
+    file size, so they survive between builds."""
+
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_path, workers=4):
+        self.cache_path = cache_path
+        self.workers = workers
+        self._sizes = None
+        self._changed = False
+
+    def get(self, paths):
+        """Return a dict with the (width, height) of each path.  Images
+        missing from the cache are read by a pool of threads."""
+        if self._sizes is None:
+            self._load()
+        result = {}
+        missing = []
+        for path in paths:
+            stat = os.stat(path)
+            key = [stat.st_mtime, stat.st_size]
+            cached = self._sizes.get(path)
+            if cached and cached[:2] == key:
+                result[path] = tuple(cached[2:])
+            else:
+                missing.append((path, key))
+        if not missing:
+            return result
+
+        missing_paths = [path for path, key in missing]
+        if self.workers > 1 and len(missing) > 1:
+            pool = ThreadPool(min(self.workers, len(missing)))
+            try:
+                sizes = pool.map(_read_image_size, missing_paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            sizes = [_read_image_size(path) for path in missing_paths]
+        for (path, key), size in zip(missing, sizes):
+            self._sizes[path] = key + list(size)
+            result[path] = tuple(size)
+        self._changed = True
+        return result
+
+    def save(self):
+        if not self._changed:
+            return
+        makedirs(os.path.dirname(self.cache_path))
+        # Write to a temporary file first, so that the cache is never left
+        # half-written by parallel builds.
+        temp_path = '{0}.{1}.tmp'.format(self.cache_path, os.getpid())
+        with io.open(temp_path, 'wb') as f:
+            f.write(json.dumps({
+                'version': self.CACHE_VERSION,
+                'sizes': self._sizes,
+            }).encode('utf-8'))
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, self.cache_path)
+        else:
+            if os.name == 'nt' and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+            os.rename(temp_path, self.cache_path)
+        self._changed = False
+
+    def _load(self):
+        self._sizes = {}
+        try:
+            with io.open(self.cache_path, 'rb') as f:
+                cache = json.loads(f.read().decode('utf-8'))
+        except (IOError, ValueError):
+            return
+        if cache.get('version') == self.CACHE_VERSION:
+            self._sizes = cache['sizes']
+
+
+def _calc_photo_data(img_list, img_titles, thumbs, output_name, sizes):
     """Unfortunately I had to copy here some code from galleries.py, there
     is no way to access it where it is."""
-    Image = None
-    try:
-        from PIL import Image # NOQA
-    except ImportError:
-        try:
-            import Image as _Image
-            Image = _Image
-        except ImportError:
-            pass
 
     def url_from_path(p):
         url = '/'.join(os.path.relpath(p,
@@ -39,11 +144,7 @@ def _calc_photo_data(img_list, img_titles, thumbs, output_name):
 
     photo_array = []
     for img, thumb, title in zip(img_list, thumbs, img_titles):
-        w, h = _image_size_cache.get(thumb, (None, None))
-        if w is None:
-            im = Image.open(thumb)
-            w, h = im.size
-            _image_size_cache[thumb] = w, h
+        w, h = sizes[thumb]
         # Thumbs are files in output, we need URLs
         photo_array.append({
             'url': url_from_path(img),
@@ -66,6 +167,9 @@ class RenderSPA(Task):
         super(RenderSPA, self).set_site(site)
         site.config['GLOBAL_CONTEXT_FILLER'].append(self.fill_context_spa)
         self._cache = {}
+        self._image_sizes = _ImageSizes(
+            os.path.join(site.config['CACHE_FOLDER'], 'spa', 'image_sizes.json'),
+            site.config.get('SPA_IMAGE_WORKERS', 4))
         self._context_fill_config = {
             'gallery.tmpl': self._fill_gallery_context,
             'index.tmpl': self._fill_index_context,
@@ -89,6 +193,7 @@ class RenderSPA(Task):
             "show_untranslated_posts": self.site.config['SHOW_UNTRANSLATED_POSTS'],
             'thumbnail_size': self.site.config['THUMBNAIL_SIZE'],
             "translations": self.site.config["TRANSLATIONS"],
+            "view_deltas": self.site.config.get('SPA_VIEW_DELTAS', True),
             "views": [
                 'post.partial',
                 'post_meta.partial',
@@ -137,6 +242,10 @@ class RenderSPA(Task):
         json_subpath = os.path.join('assets', 'json')
         json_base_path = os.path.join(self.site.config['OUTPUT_FOLDER'],
                                  json_subpath)
+        # Fragments are linked like permalinks, from the path of BASE_URL
+        base_path = urlsplit(self.site.config['BASE_URL']).path.rstrip('/')
+        kw['fragments_url'] = '/'.join(
+            [base_path] + json_subpath.split(os.sep) + ['fragments'])
         view_base_path = os.path.join(self.site.config['OUTPUT_FOLDER'], 'assets',
                                       'view')
 
@@ -180,6 +289,9 @@ class RenderSPA(Task):
             yield task
         for task in self.index_template_tasks(json_subpath):
             yield task
+        if kw['view_deltas']:
+            for task in self.fragment_tasks(json_base_path):
+                yield task
 
     def _gen_dependent_json_tasks(self, task_name, json_subpath, check_fn=None):
         plugin = self.site.plugin_manager.getPluginByName(task_name, 'Task')\
@@ -200,14 +312,28 @@ class RenderSPA(Task):
             out_target_parts.insert(len(output_folder_parts), json_subpath)
             output_name = os.path.join(*out_target_parts)
 
+            targets = [output_name]
+            if self.kw['view_deltas']:
+                targets.append(_delta_path(output_name))
+            context = in_task['actions'][0][1][2]
             yield plugin, in_task, output_name, id, {
                 'name': os.path.normpath(output_name),
-                'targets': [output_name],
+                'targets': targets,
                 'clean': True,
-                'file_dep': [file_dep],
+                'file_dep': [file_dep] + self._fragment_deps(context),
                 'basename': self.name
             }
 
+    def _fragment_deps(self, context):
+        """Return the fragments of the posts shown in a context."""
+        posts = list(context.get('posts') or [])
+        if context.get('post'):
+            posts.append(context['post'])
+        deps = []
+        for post in posts:
+            deps.extend(post.fragment_deps(context['lang']))
+        return deps
+
     def _fill_list_context(self, context, id=None):
         post_dicts = [self.post_as_dict(post, context['lang'])\
                       for post in context['posts']]
@@ -221,8 +347,8 @@ class RenderSPA(Task):
         for plugin, in_task, output_name, id, task in \
             self._gen_dependent_json_tasks('render_archive', json_subpath):
             context = in_task['actions'][0][1][2]
-            task['actions'] = [(self.compile_json, [output_name, context])]
-            self._fill_list_context(context, id)
+            task['actions'] = [(self.compile_view_json,
+                                [output_name, context, self._fill_list_context, id])]
             yield task
 
     def _fill_gallery_context(self, context, id=None):
@@ -252,18 +378,25 @@ class RenderSPA(Task):
             img_titles = in_task['actions'][0][1][4]
             thumbs = in_task['actions'][0][1][5]
 
-            self._fill_gallery_context(context, id)
             task['actions'] = [(self.compile_gallery_json,
-                                [output_name, context, img_list, img_titles, thumbs])]
+                                [output_name, context, img_list, img_titles,
+                                 thumbs, id])]
             task['file_dep'] += thumbs
             yield task
 
-    def compile_gallery_json(self, path, data, img_list, img_titles, thumbs):
+    def compile_gallery_json(self, path, data, img_list, img_titles, thumbs,
+                             id=None):
         """This needs to get width and height from the real thumbs files, so
         it can't be run at task generation time."""
-        data['photo_array'] = _calc_photo_data(img_list, img_titles, thumbs, path)
+        self._fill_gallery_context(data, id)
+        if Image is None and thumbs:
+            req_missing(['pillow'], 'build the JSON model of galleries')
+        sizes = self._image_sizes.get(thumbs)
+        self._image_sizes.save()
+        data['photo_array'] = _calc_photo_data(img_list, img_titles, thumbs,
+                                               path, sizes)
         data['photo_array_json'] = json.dumps(data['photo_array'])
-        self.compile_json(path, data)
+        self.compile_view_json(path, data)
 
     def _fill_post_context(self, context, id=None):
         post = context['post']
@@ -281,8 +414,8 @@ class RenderSPA(Task):
                 self._gen_dependent_json_tasks('render_pages',
                                                json_subpath):
             context = in_task['actions'][0][1][2]
-            self._fill_post_context(context, id)
-            task['actions'] = [(self.compile_json, [output_name, context])]
+            task['actions'] = [(self.compile_view_json,
+                                [output_name, context, self._fill_post_context, id])]
             yield task
 
     def _fill_index_context(self, context, id=None):
@@ -299,8 +432,8 @@ class RenderSPA(Task):
         for plugin, in_task, output_name, id, task in \
             self._gen_dependent_json_tasks('render_indexes', json_subpath):
             context = in_task['actions'][0][1][2]
-            task['actions'] = [(self.compile_json, [output_name, context])]
-            self._fill_index_context(context, id)
+            task['actions'] = [(self.compile_view_json,
+                                [output_name, context, self._fill_index_context, id])]
             yield task
 
     def compile_json(self, path, extractor=None, *args):
@@ -316,6 +449,65 @@ class RenderSPA(Task):
             # have find a better way to handle this
             dest.write(data)
 
+    def compile_view_json(self, path, context, fill_fn=None, id=None):
+        """Write the JSON model of a view, and its delta.  The context is
+        filled only when the task runs, so up to date tasks don't build any
+        post dict."""
+        if fill_fn:
+            fill_fn(context, id)
+        self.compile_json(path, context)
+        if self.kw['view_deltas']:
+            self.compile_json(_delta_path(path), self.view_delta(context))
+
+    def view_delta(self, context):
+        """Return the delta of a view: its context, with the posts replaced
+        by the ids of their fragments, which the client fetches once and
+        shares between views, and the client templates of its content,
+        meta, extrajs and sourcelink."""
+        delta = dict(context)
+        fragments = {}
+
+        def fragment_id(post):
+            id = _fragment_id(post['permalink'])
+            fragments[id] = '{0}/{1}.json?v={2}'.format(
+                self.kw['fragments_url'], id, _fragment_version(post))
+            return id
+
+        if isinstance(context.get('post'), dict):
+            delta['post'] = fragment_id(context['post'])
+        if context.get('posts'):
+            delta['posts'] = [fragment_id(post) for post in context['posts']]
+        delta['fragments'] = fragments
+        delta['views'] = self.kw['client_templates'].get(
+            context.get('template_name'))
+        return delta
+
+    def fragment_tasks(self, json_base_path):
+        "Tasks which write the post dicts shared by view deltas"
+        for lang in self.kw['translations']:
+            for post in self.site.timeline:
+                output_name = os.path.join(
+                    json_base_path, 'fragments',
+                    _fragment_id(post.permalink(lang)) + '.json')
+                neighbours = [(p.title(lang), p.permalink(lang)) if p else None
+                              for p in (post.prev_post, post.next_post)]
+                yield {
+                    'name': os.path.normpath(output_name),
+                    'targets': [output_name],
+                    'actions': [(self.compile_json, [output_name,
+                                                     self.post_as_dict,
+                                                     post, lang])],
+                    'clean': True,
+                    'file_dep': post.fragment_deps(lang),
+                    'uptodate': [config_changed({
+                        1: post.title(lang),
+                        2: post.meta[lang],
+                        3: post._tags[lang],
+                        4: neighbours,
+                    })],
+                    'basename': self.name
+                }
+
     def fill_context_spa(self, context, template_name):
         if template_name in self._context_fill_config:
             self._context_fill_config[template_name](context)
@@ -324,7 +516,7 @@ class RenderSPA(Task):
         result = {
             'id': _id(post, lang),
             'lang': lang,
-            'post': self.post_as_dict(self, post, lang),
+            'post': self.post_as_dict(post, lang),
             'template_name': post.template_name
         }
 
@@ -336,8 +528,9 @@ class RenderSPA(Task):
         if lang is None:
             lang = LocaleBorg().current_lang
 
+        # Each post's dict is built once, however many indexes show it
         result = self._cache.get((post, lang))
-        if result:
+        if result is not None:
             return result
         # replace  link:// stuff in the html
         extension = self.site.get_compiler(post.source_path).extension()